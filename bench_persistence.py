@@ -0,0 +1,109 @@
+"""Benchmark SQLitePersistence against PTB's PicklePersistence.
+
+Drives each backend the way Application.update_persistence does: a pass
+hands over every user and conversation touched since the last one. Stores
+drafts for many users, then times passes that each touch a few of them,
+and a cold start that reads back a handful of users.
+
+Usage: python bench_persistence.py [users] [dirty_per_pass] [passes]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_persistence_"))
+
+import main
+from telegram.ext import PicklePersistence, PersistenceInput
+
+CONVERSATION = "ticket_draft"
+
+
+def draft(user_id: int, revision: int) -> dict:
+    return {
+        "section": "📊 فارکس",
+        "messages": [("متن", f"پیام {i} از کاربر {user_id}، نسخه {revision}") for i in range(5)],
+    }
+
+
+def build(kind: str, directory: str):
+    if kind == "sqlite":
+        return main.SQLitePersistence(os.path.join(directory, "bench.sqlite3"))
+    return PicklePersistence(
+        os.path.join(directory, "bench.pickle"),
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        on_flush=(kind == "pickle-on-flush")
+    )
+
+
+async def persist_pass(persistence, kind: str, users, revision: int) -> None:
+    """One update_persistence pass, until the data is on disk"""
+    await asyncio.gather(*(
+        coroutine
+        for user_id in users
+        for coroutine in (
+            persistence.update_user_data(user_id, draft(user_id, revision)),
+            persistence.update_conversation(CONVERSATION, (user_id, user_id), main.GET_MESSAGE),
+        )
+    ))
+    if kind == "sqlite":
+        await persistence.write_dirty()
+    elif kind == "pickle-on-flush":
+        await persistence.flush()
+
+
+def file_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+async def run(kind: str, users: int, dirty: int, passes: int) -> None:
+    directory = tempfile.mkdtemp(prefix=f"{kind}_", dir=os.environ["DATA_DIR"])
+    # Write-through pickle would re-dump the whole file once per user here, so it starts from on_flush's file
+    seed_kind = "pickle-on-flush" if kind == "pickle" else kind
+    persistence = build(seed_kind, directory)
+    await persistence.get_user_data()
+    await persistence.get_conversations(CONVERSATION)
+
+    started = time.perf_counter()
+    await persist_pass(persistence, seed_kind, range(users), 0)
+    initial = time.perf_counter() - started
+    if seed_kind != kind:
+        await persistence.flush()
+        persistence = build(kind, directory)
+        await persistence.get_user_data()
+        await persistence.get_conversations(CONVERSATION)
+
+    timings = []
+    for revision in range(1, passes + 1):
+        touched = [(revision * dirty + i) * 7919 % users for i in range(dirty)]
+        started = time.perf_counter()
+        await persist_pass(persistence, kind, touched, revision)
+        timings.append(time.perf_counter() - started)
+    await persistence.flush()
+
+    started = time.perf_counter()
+    reloaded = build(kind, directory)
+    user_data = await reloaded.get_user_data()
+    await reloaded.get_conversations(CONVERSATION)
+    for user_id in range(0, users, max(1, users // 100)):
+        await reloaded.refresh_user_data(user_id, user_data.setdefault(user_id, {}))
+    cold_start = time.perf_counter() - started
+    await reloaded.flush()
+
+    timings.sort()
+    print(f"{kind}:")
+    print(f"  initial pass, {users} users:       {initial * 1000:.0f} ms")
+    print(f"  pass of {dirty} dirty users, p50:      {timings[len(timings) // 2] * 1000:.1f} ms")
+    print(f"  pass of {dirty} dirty users, max:      {timings[-1] * 1000:.1f} ms")
+    print(f"  cold start + 100 user reads:      {cold_start * 1000:.0f} ms")
+    print(f"  on disk:                          {file_size(directory) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    dirty_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    pass_count = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    for backend in ("sqlite", "pickle-on-flush", "pickle"):
+        asyncio.run(run(backend, user_count, dirty_count, pass_count))
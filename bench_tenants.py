@@ -0,0 +1,137 @@
+"""Benchmark memory and CPU cost per hosted bot in multi-bot mode.
+
+Builds N bots the way run_tenants() does (shared outbound pool and outbox),
+answers every Bot API call locally instead of over the network, and runs a
+user ticket flow through each bot's real handlers.
+
+Usage: python bench_tenants.py [tenants] [users_per_tenant]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import tracemalloc
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_tenants_"))
+os.environ.setdefault("BACKLOG_RATE", "1000000")
+
+import main
+from telegram import Update
+from telegram.request import BaseRequest
+
+
+class LocalRequest(BaseRequest):
+    """Answers Bot API calls in-process with minimal valid results"""
+
+    def __init__(self):
+        self.calls = 0
+        self.users = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        self.users += 1
+
+    async def shutdown(self):
+        self.users -= 1
+
+    def metrics(self):
+        return {"requests": self.calls}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint.startswith(("send", "edit")):
+            result = {
+                "message_id": self.calls,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": "",
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(update_id: int, user_id: int, text: str, bot) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+        },
+    }, bot)
+
+
+async def run(tenants: int, users: int) -> None:
+    request = LocalRequest()
+    outbox = main.Outbox()
+    configs = [
+        main.BotConfig(f"bench{i}", f"{100000 + i}:bench", ["9000001"], ["9000002"], "9000003", {})
+        for i in range(tenants)
+    ]
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    apps = []
+    for config in configs:
+        app = main.build_application(config, send_request=request)
+        app.bot_data["outbox"] = outbox
+        await app.initialize()
+        await main.post_init(app)
+        apps.append(app)
+    outbox.bury_orphans()
+    worker = asyncio.create_task(outbox.run())
+
+    after = tracemalloc.take_snapshot()
+    idle_bytes = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+    update_id = 0
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    for app in apps:
+        for user in range(users):
+            user_id = 10_000_000 + user
+            for text in ("📊 فارکس", "سلام، سوال دارم", "📤 ارسال پیام"):
+                update_id += 1
+                await app.process_update(make_update(update_id, user_id, text, app.bot))
+    while outbox.queue:
+        await asyncio.sleep(0.01)
+    cpu = time.process_time() - cpu_started
+    wall = time.perf_counter() - wall_started
+
+    loaded = tracemalloc.take_snapshot()
+    loaded_bytes = sum(stat.size_diff for stat in loaded.compare_to(before, "filename"))
+    tracemalloc.stop()
+
+    worker.cancel()
+    for app in apps:
+        await main.post_stop(app)
+        await app.shutdown()
+
+    print(f"tenants:                   {tenants}")
+    print(f"tickets per tenant:        {users}")
+    print(f"memory per idle tenant:    {idle_bytes / tenants / 1024:.1f} KiB")
+    print(f"memory per loaded tenant:  {loaded_bytes / tenants / 1024:.1f} KiB")
+    print(f"cpu per tenant:            {cpu / tenants * 1000:.1f} ms")
+    print(f"cpu per update:            {cpu / update_id * 1e6:.0f} µs")
+    print(f"updates per second:        {update_id / wall:.0f}")
+    print(f"bot api calls:             {request.calls}")
+
+
+if __name__ == "__main__":
+    tenant_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    user_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    asyncio.run(run(tenant_count, user_count))
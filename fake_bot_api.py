@@ -0,0 +1,316 @@
+"""Local stand-in for the Telegram Bot API, for soak and load tests.
+
+Speaks just enough HTTP/1.1 (keep-alive, form-encoded, JSON and multipart
+bodies) to serve python-telegram-bot, and implements getMe, getUpdates,
+deleteWebhook, the send* methods, editMessageText and answerCallbackQuery.
+Calls other than getMe/getUpdates/deleteWebhook can be slowed down, answered
+with 429 retry_after, failed with a 500, or have their connection dropped.
+
+Tests feed user traffic in with push_update() and watch what the bot sends
+through the on_send callback.
+
+Usage: python fake_bot_api.py [port]
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+UNFAULTED_METHODS = {"getme", "getupdates", "deletewebhook"}
+JSON_PARAMS = {"reply_markup", "media", "entities", "caption_entities", "allowed_updates", "link_preview_options"}
+
+
+class FakeBotAPI:
+    """In-process Bot API server; one instance serves any number of bot tokens"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0,
+                 retry_after: int = 1, failure_rate: float = 0.0, drop_rate: float = 0.0,
+                 max_rps: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit  # share of calls answered with 429
+        self.retry_after = retry_after
+        self.failure_rate = failure_rate  # share of calls answered with 500
+        self.drop_rate = drop_rate  # share of calls whose connection is closed unanswered
+        self.max_rps = max_rps  # global flood limit per bot, 0 for none
+        self.random = random.Random(seed)
+        self.on_send: Optional[Callable[[str, str, Dict, Dict], None]] = None
+
+        self.updates: Dict[str, List[Dict]] = {}
+        self.update_ids: Dict[str, int] = {}
+        self.new_updates: Dict[str, asyncio.Condition] = {}
+        self.message_ids: Dict[str, int] = {}
+        self.flood: Dict[str, List[float]] = {}  # token -> [tokens, last refill]
+        self.calls = Counter()
+        self.faults = Counter()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections = set()
+        self.port = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            for task in list(self.connections):
+                task.cancel()
+            await self.server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def push_update(self, token: str, update: Dict) -> int:
+        """Queue an update (without update_id) for the bot's next getUpdates"""
+        update_id = self.update_ids.get(token, 0) + 1
+        self.update_ids[token] = update_id
+        self.updates.setdefault(token, []).append({"update_id": update_id, **update})
+        condition = self.condition(token)
+
+        async def notify():
+            async with condition:
+                condition.notify_all()
+        asyncio.get_running_loop().create_task(notify())
+        return update_id
+
+    def condition(self, token: str) -> asyncio.Condition:
+        if token not in self.new_updates:
+            self.new_updates[token] = asyncio.Condition()
+        return self.new_updates[token]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.dispatch(target, headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    def parse_params(self, target: str, headers: Dict, body: bytes) -> Dict:
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json") and body:
+            params.update(json.loads(body))
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode()))
+        elif content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True)
+                params[name] = payload.decode() if part.get_filename() is None else f"upload:{len(payload)}"
+        for name in JSON_PARAMS & params.keys():
+            if isinstance(params[name], str):
+                params[name] = json.loads(params[name])
+        return params
+
+    async def dispatch(self, target: str, headers: Dict, body: bytes):
+        path = urlsplit(target).path
+        try:
+            _, bot_token, method = path.split("/", 2)
+        except ValueError:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        token = bot_token[3:]
+        params = self.parse_params(target, headers, body)
+        self.calls[method] += 1
+
+        if method.lower() not in UNFAULTED_METHODS:
+            fault = await self.inject_fault(token)
+            if fault is not None:
+                return fault
+
+        handler = getattr(self, f"api_{method.lower()}", None)
+        if handler is None:
+            if method.lower().startswith("send"):
+                handler = self.api_sendmessage
+            else:
+                return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        try:
+            result = await handler(token, method, params)
+        except (KeyError, ValueError) as e:
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+        return 200, {"ok": True, "result": result}
+
+    async def inject_fault(self, token: str):
+        """Delay the call, then return None to serve it, a (status, payload) error, or drop the connection"""
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.max_rps:
+            now = time.monotonic()
+            bucket = self.flood.setdefault(token, [self.max_rps, now])
+            bucket[0] = min(self.max_rps, bucket[0] + (now - bucket[1]) * self.max_rps)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.faults["flood_429"] += 1
+                return self.too_many_requests()
+            bucket[0] -= 1
+
+        roll = self.random.random()
+        if roll < self.rate_limit:
+            self.faults["429"] += 1
+            return self.too_many_requests()
+        roll -= self.rate_limit
+        if roll < self.failure_rate:
+            self.faults["500"] += 1
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        roll -= self.failure_rate
+        if roll < self.drop_rate:
+            self.faults["dropped"] += 1
+            raise ConnectionResetError
+        return None
+
+    def too_many_requests(self):
+        return 429, {
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {self.retry_after}",
+            "parameters": {"retry_after": self.retry_after},
+        }
+
+    def bot_user(self, token: str) -> Dict:
+        bot_id = int(token.split(":", 1)[0])
+        return {"id": bot_id, "is_bot": True, "first_name": "Fake", "username": f"fake{bot_id}_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def message(self, token: str, chat_id, **fields) -> Dict:
+        key = f"{token}/{chat_id}"
+        self.message_ids[key] = self.message_ids.get(key, 0) + 1
+        return {
+            "message_id": self.message_ids[key],
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": self.bot_user(token),
+            **fields,
+        }
+
+    def sent(self, token: str, method: str, params: Dict, message: Dict) -> None:
+        if self.on_send is not None:
+            self.on_send(token, method, params, message)
+
+    async def api_getme(self, token: str, method: str, params: Dict):
+        return self.bot_user(token)
+
+    async def api_deletewebhook(self, token: str, method: str, params: Dict):
+        return True
+
+    async def api_answercallbackquery(self, token: str, method: str, params: Dict):
+        return True
+
+    async def api_getupdates(self, token: str, method: str, params: Dict):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        queue = self.updates.setdefault(token, [])
+        queue[:] = [u for u in queue if u["update_id"] >= offset]
+        if not queue and timeout:
+            condition = self.condition(token)
+            try:
+                async with condition:
+                    await asyncio.wait_for(condition.wait_for(lambda: bool(queue)), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return queue[:limit]
+
+    async def api_sendmessage(self, token: str, method: str, params: Dict):
+        fields = {}
+        if "text" in params:
+            fields["text"] = params["text"]
+        if params.get("caption"):
+            fields["caption"] = params["caption"]
+        kind = method[4:].lower()
+        if kind in ("photo", "voice", "document", "audio", "video"):
+            file_id = params.get(kind, "")
+            file = {"file_id": file_id, "file_unique_id": file_id[-16:] or "upload"}
+            fields[kind] = [{**file, "width": 1, "height": 1}] if kind == "photo" else file
+            if kind in ("voice", "audio", "video"):
+                fields[kind]["duration"] = 1
+            if kind == "video":
+                fields[kind].update(width=1, height=1)
+        if "reply_markup" in params and "inline_keyboard" in params["reply_markup"]:
+            fields["reply_markup"] = params["reply_markup"]
+        message = self.message(token, params["chat_id"], **fields)
+        self.sent(token, method, params, message)
+        return message
+
+    async def api_sendmediagroup(self, token: str, method: str, params: Dict):
+        messages = []
+        for item in params["media"]:
+            file = {"file_id": item["media"], "file_unique_id": item["media"][-16:]}
+            fields = {"media_group_id": f"{token}/{params['chat_id']}"}
+            if item.get("caption"):
+                fields["caption"] = item["caption"]
+            if item["type"] == "photo":
+                fields["photo"] = [{**file, "width": 1, "height": 1}]
+            else:
+                fields[item["type"]] = file
+            messages.append(self.message(token, params["chat_id"], **fields))
+        for message in messages:
+            self.sent(token, method, params, message)
+        return messages
+
+    async def api_editmessagetext(self, token: str, method: str, params: Dict):
+        if "inline_message_id" in params:
+            return True
+        message = {
+            "message_id": int(params["message_id"]),
+            "date": int(time.time()),
+            "edit_date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": self.bot_user(token),
+            "text": params["text"],
+        }
+        if "reply_markup" in params:
+            message["reply_markup"] = params["reply_markup"]
+        self.sent(token, method, params, message)
+        return message
+
+
+async def serve(port: int) -> None:
+    api = FakeBotAPI()
+    await api.start(port=port)
+    print(f"Fake Bot API listening on {api.base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8081))
@@ -1,15 +1,41 @@
 from dotenv import load_dotenv
 import os
+import csv
+import gzip
+import json
+import time
+import signal
+import asyncio
 import logging
-from typing import List, Dict
-from datetime import datetime
+import mmap
+import tempfile
+import importlib.util
+import uuid
+import heapq
+import math
+import sqlite3
+import sys
+import threading
+import traceback
+import tracemalloc
+import gc
+from collections import OrderedDict, Counter
+from typing import List, Dict, Optional
+from datetime import datetime, timedelta, timezone
 
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+from telegram import (
+    Update, Message, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto,
+    InputMediaDocument
+)
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, ConversationHandler,
-    ContextTypes, filters, CallbackQueryHandler
+    ContextTypes, filters, CallbackQueryHandler, SimpleUpdateProcessor, TypeHandler,
+    ApplicationHandlerStop, BasePersistence, PersistenceInput
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, TimedOut
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest, HTTPXRequest
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -19,8 +45,10 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN environment variable is required")
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+ADMINS_FILE = os.getenv("ADMINS_FILE")  # admin roles and names, replaces the env lists below
+ADMIN_RELOAD_INTERVAL = float(os.getenv("ADMIN_RELOAD_INTERVAL", "5"))  # seconds between admin file checks
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")  # e.g. a local Bot API server
 
 PRIMARY_ADMINS_STR = os.getenv("PRIMARY_ADMINS", "")
 PRIMARY_ADMINS: List[str] = [a.strip() for a in PRIMARY_ADMINS_STR.split(",") if a.strip()]
@@ -37,8 +65,87 @@ ADMIN_NAMES = {
     "108039886": "غلامی"
 }
 
-if not PRIMARY_ADMINS:
-    logger.warning("No PRIMARY_ADMINS configured. Messages won't be forwarded.")
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # messages per second
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "25"))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", "100"))
+
+ROLLUP_EVENTS = ("created", "delegated", "answered", "completed")
+EVENT_TIMESTAMPS = {
+    "created": "created_at",
+    "delegated": "delegated_at",
+    "answered": "first_reply_at",
+    "completed": "completed_at",
+}
+LATENCY_METRICS = (("delegate", "ارجاع"), ("first_reply", "اولین پاسخ"), ("close", "بستن"))
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv("ROLLUP_HOURLY_RETENTION_DAYS", "14"))
+
+STATE_FLUSH_INTERVAL = int(os.getenv("STATE_FLUSH_INTERVAL", "60"))  # seconds
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))  # seconds between draft/conversation flushes
+BACKLOG_RATE = float(os.getenv("BACKLOG_RATE", "5"))  # backlog updates per second after a restart
+BACKLOG_MAX_WAITING = 256  # fetched updates that may wait for their turn at once
+
+UPDATES_POOL_SIZE = int(os.getenv("UPDATES_POOL_SIZE", "2"))
+UPDATES_POOL_TIMEOUT = float(os.getenv("UPDATES_POOL_TIMEOUT", "1"))
+SEND_POOL_SIZE = int(os.getenv("SEND_POOL_SIZE", "16"))  # shared by all bots in multi-bot mode
+SEND_POOL_MAX_SIZE = int(os.getenv("SEND_POOL_MAX_SIZE", "128"))
+SEND_POOL_TIMEOUT = float(os.getenv("SEND_POOL_TIMEOUT", "5"))
+SEND_POOL_GROW_BACKLOG = int(os.getenv("SEND_POOL_GROW_BACKLOG", "50"))  # outbox entries
+SEND_POOL_CHECK_INTERVAL = float(os.getenv("SEND_POOL_CHECK_INTERVAL", "5"))  # seconds
+SEND_POOL_RESERVED = 4  # connections left for handlers when the outbox scales up
+HTTP_VERSION = os.getenv("HTTP_VERSION", "1.1")  # "1.1" or "2"
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))  # seconds
+HTTP_RETIRE_GRACE = 60  # seconds a replaced client keeps serving in-flight requests
+
+TRANSCRIPT_SEGMENT_BYTES = int(os.getenv("TRANSCRIPT_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+TRANSCRIPT_FLUSH_INTERVAL = float(os.getenv("TRANSCRIPT_FLUSH_INTERVAL", "1"))  # seconds
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))  # messages per second a user may sustain
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "10"))
+FLOOD_MUTE_AFTER = int(os.getenv("FLOOD_MUTE_AFTER", "20"))  # dropped messages in a row
+FLOOD_MUTE_SECONDS = int(os.getenv("FLOOD_MUTE_SECONDS", "600"))
+FLOOD_SWEEP_INTERVAL = 60  # seconds
+
+ROUTE_INDEX_SIZE = int(os.getenv("ROUTE_INDEX_SIZE", "20000"))  # relayed messages remembered for reply routing
+HISTORY_PAGE_SIZE = 15
+HISTORY_TEXT_LIMIT = 200  # characters per message shown by /history
+ACK_DEBOUNCE_MS = int(os.getenv("ACK_DEBOUNCE_MS", "1500"))  # quiet time before acknowledging a burst
+RELAY_COALESCE_MS = int(os.getenv("RELAY_COALESCE_MS", "800"))  # quiet time before relaying a burst of texts
+RELAY_MAX_DELAY_MS = int(os.getenv("RELAY_MAX_DELAY_MS", "3000"))  # no text waits longer than this
+RELAY_MESSAGE_LIMIT = 4000  # Telegram allows 4096 characters per message
+RELAY_ACK_TEXT = "📤 پیام شما دریافت شد و برای پشتیبان ارسال می‌شود."
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "5"))  # /profile sampling period
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP_FUNCTIONS = 10
+MEMSTATS_SAMPLE = 200  # structures are sized from this many sampled entries
+MEMSTATS_TOP = 10
+DASHBOARD_HOST = os.getenv("DASHBOARD_HOST", "127.0.0.1")
+DASHBOARD_PORT = int(os.getenv("DASHBOARD_PORT", "0"))  # 0 disables the dashboard
+DASHBOARD_QUEUE_LIMIT = 200  # waiting tickets listed
+DASHBOARD_EVENT_BUFFER = 1000  # events a slow /events client may fall behind by
+DASHBOARD_HEARTBEAT = 15  # seconds
+SKETCH_ACCURACY = 0.02  # relative error of reported response-time quantiles
+SKETCH_MAX_BINS = 512  # past this the fastest bins are merged
+SLOW_CALLBACK_MS = int(os.getenv("SLOW_CALLBACK_MS", "500"))  # log loop stalls longer than this; 0 disables
+
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "1"))  # seconds
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BASE_DELAY = float(os.getenv("OUTBOX_BASE_DELAY", "1"))  # seconds, doubled per attempt
+OUTBOX_MAX_DELAY = float(os.getenv("OUTBOX_MAX_DELAY", "300"))
+OUTBOX_DEDUP_KEYS = int(os.getenv("OUTBOX_DEDUP_KEYS", "10000"))
+OUTBOX_DEAD_LETTER_LIMIT = int(os.getenv("OUTBOX_DEAD_LETTER_LIMIT", "200"))
+
+ANNOUNCEMENT_STATE = "announcement.json"
+BLOCKED_USERS_STATE = "blocked_users.json"
+ROLLUP_STATE = "rollups.json"
+TICKETS_STATE = "tickets.json"
+OUTBOX_JOURNAL = "outbox.jsonl"
+OUTBOX_DEAD_LETTER_STATE = "dead_letters.json"
+METRICS_STATE = "metrics.json"
+ROUTES_STATE = "routes.json"
+LATENCY_STATE = "latency.json"
+PERSISTENCE_FILE = "persistence.sqlite3"
 
 GET_MESSAGE = 1
 
@@ -56,26 +163,389 @@ action_buttons = [
 keyboard = ReplyKeyboardMarkup(main_buttons, resize_keyboard=True)
 action_keyboard = ReplyKeyboardMarkup(action_buttons, resize_keyboard=True)
 
-def get_admin_name(admin_id: str) -> str:
-    """Get admin display name"""
-    return ADMIN_NAMES.get(admin_id, f"ادمین {admin_id}")
+def data_path(name: str) -> str:
+    """Path of a state file inside DATA_DIR"""
+    path = os.path.join(DATA_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def state_file(application, name: str) -> str:
+    """State file name inside the bot's own namespace (a DATA_DIR subdirectory per tenant)"""
+    return os.path.join(application.bot_data["config"].name, name)
+
+def load_state(name: str, default=None):
+    """Load a JSON state file, falling back to default if missing or broken"""
+    try:
+        with open(data_path(name), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logger.error(f"Error loading state {name}: {e}")
+        return default
+
+def write_state(name: str, payload: str) -> None:
+    """Atomically write a state file (write to temp file, then rename)"""
+    path = data_path(name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def save_state(name: str, data) -> None:
+    """Atomically write a JSON state file"""
+    write_state(name, json.dumps(data, ensure_ascii=False))
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Normalize RetryAfter.retry_after, which is an int or a timedelta depending on PTB version"""
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+def start_background_task(application, coroutine, name: str) -> asyncio.Task:
+    """Run a long-lived coroutine that is cancelled (not awaited) on shutdown"""
+    task = asyncio.create_task(coroutine, name=name)
+    tasks = application.bot_data.setdefault("background_tasks", set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+class BotConfig:
+    """Token, admin roles and display names of one hosted bot
+
+    The env-configured bot has an empty name; bots loaded from TENANTS_FILE are
+    named, and the name is their state namespace in DATA_DIR and the outbox.
+    """
+
+    def __init__(self, name: str, token: str, primary_admins: List[str], secondary_admins: List[str],
+                 super_admin: Optional[str], admin_names: Dict[str, str]):
+        self.name = name
+        self.token = token
+        self.primary_admins = [str(a) for a in primary_admins]
+        self.secondary_admins = [str(a) for a in secondary_admins]
+        self.super_admin = str(super_admin) if super_admin else None
+        self.admin_names = {str(k): v for k, v in admin_names.items()}
+
+    def admin_name(self, admin_id: str) -> str:
+        """Get admin display name"""
+        return self.admin_names.get(admin_id, f"ادمین {admin_id}")
+
+def bot_config_from_entry(name: str, token: str, entry: Dict) -> BotConfig:
+    """Build a BotConfig from the admin fields of a JSON config entry"""
+    primary_admins = entry.get("primary_admins", [])
+    secondary_admins = entry.get("secondary_admins", [])
+    admin_names = entry.get("admin_names", {})
+    if not isinstance(primary_admins, list) or not isinstance(secondary_admins, list):
+        raise ValueError("primary_admins and secondary_admins must be lists")
+    if not all(isinstance(aid, (str, int)) for aid in primary_admins + secondary_admins):
+        raise ValueError("admin IDs must be strings or numbers")
+    if not isinstance(admin_names, dict):
+        raise ValueError("admin_names must be an object")
+    return BotConfig(name, token, primary_admins, secondary_admins, entry.get("super_admin"), admin_names)
+
+def admin_config_path() -> Optional[str]:
+    """The file admin roles are read from and watched in, if any"""
+    return TENANTS_FILE or ADMINS_FILE
+
+def read_admin_entry(name: str) -> Dict:
+    """Admin fields of one bot: the whole ADMINS_FILE object, or its entry in the TENANTS_FILE list"""
+    path = admin_config_path()
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if TENANTS_FILE:
+        if not isinstance(data, list) or not all(isinstance(entry, dict) for entry in data):
+            raise ValueError(f"{path} must be a list of objects")
+        data = next((entry for entry in data if entry.get("name") == name), None)
+    if not isinstance(data, dict):
+        raise ValueError(f"No admin config for bot '{name}' in {path}")
+    return data
+
+def load_bot_configs() -> List[BotConfig]:
+    """One config from the environment, or one per entry of the TENANTS_FILE JSON list
+
+    With ADMINS_FILE set, the env-configured bot takes its admins from that
+    JSON object (primary_admins, secondary_admins, super_admin, admin_names)
+    instead of the environment. Either file is watched for admin changes.
+    """
+    if not TENANTS_FILE:
+        if not BOT_TOKEN:
+            raise ValueError("BOT_TOKEN environment variable is required")
+        if ADMINS_FILE:
+            configs = [bot_config_from_entry("", BOT_TOKEN, read_admin_entry(""))]
+        else:
+            configs = [BotConfig("", BOT_TOKEN, PRIMARY_ADMINS, SECONDARY_ADMINS, SUPER_ADMIN, ADMIN_NAMES)]
+    else:
+        with open(TENANTS_FILE, encoding="utf-8") as f:
+            entries = json.load(f)
+        configs = [bot_config_from_entry(entry["name"], entry["token"], entry) for entry in entries]
+        names = [config.name for config in configs]
+        if not all(names) or len(set(names)) != len(names):
+            raise ValueError(f"Tenant names in {TENANTS_FILE} must be non-empty and unique")
+
+    for config in configs:
+        if not config.primary_admins:
+            logger.warning(f"No PRIMARY_ADMINS configured for bot '{config.name}'. Messages won't be forwarded.")
+    return configs
+
+def get_config(context) -> BotConfig:
+    return context.bot_data["config"]
+
+def role_user_ids(config: BotConfig) -> Dict[str, List[int]]:
+    """User IDs behind the handler filters: every admin, and secondary admins"""
+    all_admins = config.secondary_admins + config.primary_admins
+    if config.super_admin:
+        all_admins.append(config.super_admin)
+    return {
+        "admins": [int(aid) for aid in all_admins if aid.isdigit()],
+        "secondary": [int(aid) for aid in config.secondary_admins if aid.isdigit()],
+    }
+
+def apply_admin_config(application, config: BotConfig) -> None:
+    """Swap in reloaded admins: handler filters, the config handlers read, then open tickets and keyboards
 
-def create_delegation_keyboard(message_id: str) -> InlineKeyboardMarkup:
+    Nothing here awaits, so no update is handled against half-applied roles.
+    """
+    bot_data = application.bot_data
+    old = bot_data["config"]
+    for role, user_ids in role_user_ids(config).items():
+        bot_data["role_filters"][role].user_ids = user_ids
+    bot_data["config"] = config
+
+    before = set(old.primary_admins + old.secondary_admins)
+    after = set(config.primary_admins + config.secondary_admins)
+    logger.info(
+        f"Reloaded admins of bot '{config.name}': added {sorted(after - before)}, removed {sorted(before - after)}"
+    )
+    # Open tickets of removed secondary admins go back to the queue, offered to the primary admins again
+    removed = set(old.secondary_admins) - set(config.secondary_admins)
+    for ticket_id, ticket in bot_data.get("pending_messages", {}).items():
+        admin_id = ticket.get("delegated_to")
+        if admin_id in removed and not ticket.get("completed"):
+            release_ticket(bot_data, ticket_id, ticket, f"{old.admin_name(admin_id)} از فهرست پشتیبان‌ها حذف شد.")
+            logger.info(f"Released ticket {ticket_id} of removed admin {admin_id}")
+    buttons = lambda c: [(aid, c.admin_name(aid)) for aid in c.secondary_admins]
+    buttons_changed = buttons(old) != buttons(config)
+    if buttons_changed or set(old.primary_admins) - set(config.primary_admins):
+        refresh_delegation_keyboards(application, buttons_changed)
+
+def refresh_delegation_keyboards(application, buttons_changed: bool = True) -> None:
+    """Queue edits of unclaimed tickets' delegation keyboards to the current secondary admins
+
+    Keyboards held by someone who is no longer a primary admin are removed.
+    Unless buttons_changed, the others are left alone: Telegram refuses an
+    edit to the same markup.
+    """
+    bot_data = application.bot_data
+    config = bot_data["config"]
+    version = time.time_ns()
+    for ticket_id, ticket in bot_data.get("pending_messages", {}).items():
+        if not ticket.get("keyboards") or not is_unassigned(ticket):
+            continue
+        markup = create_delegation_keyboard(config, ticket_id).to_dict()
+        for admin_id, message_id in list(ticket["keyboards"].items()):
+            kwargs = {"message_id": message_id}
+            if admin_id not in config.primary_admins:
+                del ticket["keyboards"][admin_id]
+            elif buttons_changed:
+                kwargs["reply_markup"] = markup
+            else:
+                continue
+            bot_data["outbox"].enqueue(
+                config.name, "edit_message_reply_markup", admin_id,
+                key=f"keyboard:{version}:{ticket_id}:{admin_id}", **kwargs
+            )
+        bot_data["tickets_dirty"] = True
+
+async def admin_config_watch_loop(application, path: str) -> None:
+    """Reload this bot's admins whenever the admin config file changes"""
+    name = application.bot_data["config"].name
+    last = None
+    while True:
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if last is not None and stamp != last:
+                # A broken save is reported once; the next save is picked up again
+                last = stamp
+                entry = await asyncio.to_thread(read_admin_entry, name)
+                config = bot_config_from_entry(name, application.bot_data["config"].token, entry)
+                apply_admin_config(application, config)
+            last = stamp
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reloading admins from {path}: {e}")
+        await asyncio.sleep(ADMIN_RELOAD_INTERVAL)
+
+def create_delegation_keyboard(config: BotConfig, message_id: str) -> InlineKeyboardMarkup:
     """Create inline keyboard for delegating to secondary admins"""
     buttons = []
-    for admin_id in SECONDARY_ADMINS:
-        admin_name = get_admin_name(admin_id)
+    for admin_id in config.secondary_admins:
+        admin_name = config.admin_name(admin_id)
         buttons.append([InlineKeyboardButton(f"ارسال به {admin_name}", 
                                            callback_data=f"delegate_{admin_id}_{message_id}")])
     return InlineKeyboardMarkup(buttons)
 
+class FloodGuard:
+    """Per-user token buckets for incoming messages, with a temporary mute list
+
+    Each user gets FLOOD_BURST tokens refilled at FLOOD_RATE per second; a
+    message without a token is dropped before any handler runs, so it costs
+    no outbound API call. FLOOD_MUTE_AFTER drops in a row mute the user for
+    FLOOD_MUTE_SECONDS. Idle buckets and expired mutes are swept regularly.
+    """
+
+    def __init__(self):
+        self.buckets: Dict[int, List[float]] = {}  # user_id -> [tokens, last_seen, drops]
+        self.muted: Dict[int, float] = {}  # user_id -> muted until
+        self.dropped = 0
+        self.mutes = 0
+        self.next_sweep = 0.0
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        until = self.muted.get(user_id)
+        if until is not None:
+            if now < until:
+                self.dropped += 1
+                return False
+            del self.muted[user_id]
+
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = [float(FLOOD_BURST), now, 0]
+        else:
+            bucket[0] = min(float(FLOOD_BURST), bucket[0] + (now - bucket[1]) * FLOOD_RATE)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = 0
+            return True
+
+        self.dropped += 1
+        bucket[2] += 1
+        if bucket[2] >= FLOOD_MUTE_AFTER:
+            self.mute(user_id, FLOOD_MUTE_SECONDS)
+        return False
+
+    def mute(self, user_id: int, seconds: float) -> None:
+        logger.warning(f"Muting user {user_id} for {seconds}s after flooding")
+        self.muted[user_id] = time.monotonic() + seconds
+        self.buckets.pop(user_id, None)
+        self.mutes += 1
+
+    def unmute(self, user_id: int) -> bool:
+        return self.muted.pop(user_id, None) is not None
+
+    def sweep(self, now: float) -> None:
+        """Forget buckets idle long enough to be full again, and expired mutes"""
+        idle_cutoff = now - FLOOD_BURST / FLOOD_RATE
+        for user_id in [u for u, b in self.buckets.items() if b[1] < idle_cutoff]:
+            del self.buckets[user_id]
+        for user_id in [u for u, until in self.muted.items() if until <= now]:
+            del self.muted[user_id]
+        self.next_sweep = now + FLOOD_SWEEP_INTERVAL
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop messages from users who exceed their rate before other handlers run"""
+    if not update.message or not update.effective_user:
+        return
+
+    config = get_config(context)
+    user_id = str(update.effective_user.id)
+    if user_id in config.primary_admins or user_id in config.secondary_admins or user_id == config.super_admin:
+        return
+
+    # Messages that queued up while the bot was down are replayed at BACKLOG_RATE, not the user's pace
+    if context.application.update_processor.is_backlog(update):
+        return
+
+    if not context.bot_data["flood"].allow(update.effective_user.id):
+        raise ApplicationHandlerStop
+
+async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lift a flood mute (Primary admins only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+    if user_id not in config.primary_admins:
+        return
+
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text(
+            "📝 *نحوه استفاده:*\n"
+            "`/unmute شناسه_کاربر`",
+            parse_mode="Markdown"
+        )
+        return
+
+    if context.bot_data["flood"].unmute(int(context.args[0])):
+        await update.message.reply_text(f"🔊 محدودیت کاربر {context.args[0]} برداشته شد.")
+    else:
+        await update.message.reply_text(f"❌ کاربر {context.args[0]} محدود نشده است.")
+
+class Debouncer:
+    """Coalesces repeated schedule() calls for a key into one delayed callback
+
+    Every call pushes the callback back by `window` seconds; with `max_delay`
+    it still fires no later than max_delay after the first call in the burst.
+    The most recently scheduled callback is the one that runs.
+    """
+
+    def __init__(self):
+        self.pending: Dict[str, list] = {}  # key -> [timer handle, callback, burst start]
+        self.running = set()
+
+    def schedule(self, key: str, callback, window: float, max_delay: Optional[float] = None) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        started = now
+        entry = self.pending.get(key)
+        if entry is not None:
+            entry[0].cancel()
+            started = entry[2]
+
+        delay = window
+        if max_delay is not None:
+            delay = max(0.0, min(window, started + max_delay - now))
+        self.pending[key] = [loop.call_later(delay, self.fire, key), callback, started]
+
+    def cancel(self, key: str) -> None:
+        entry = self.pending.pop(key, None)
+        if entry is not None:
+            entry[0].cancel()
+
+    def fire(self, key: str) -> None:
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+        task = asyncio.create_task(self.run(key, entry[1]))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run(self, key: str, callback) -> None:
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Debounced callback {key} failed: {e}")
+
+    async def flush(self) -> None:
+        """Run everything still waiting for its window, e.g. on shutdown"""
+        for key in list(self.pending):
+            self.pending[key][0].cancel()
+            self.fire(key)
+        await asyncio.gather(*self.running, return_exceptions=True)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id in PRIMARY_ADMINS:
+    if user_id in config.primary_admins:
         await update.message.reply_text("👑 سلام ادمین اصلی عزیز! به پنل مدیریت ربات وصل شدید ✅")
-    elif user_id in SECONDARY_ADMINS:
-        admin_name = get_admin_name(user_id)
+    elif user_id in config.secondary_admins:
+        admin_name = config.admin_name(user_id)
         await update.message.reply_text(
             f"🔧 سلام {admin_name} عزیز! به پنل پشتیبانی وصل شدید ✅\n\n"
             f"📝 *نحوه پاسخ‌دهی:*\n"
@@ -134,10 +604,11 @@ async def get_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await handle_navigation(update, context)
     
     if text == "📤 ارسال پیام":
+        context.bot_data["debouncer"].cancel(f"ack:{update.effective_chat.id}")
         await send_to_primary_admins(update, context)
         context.user_data.clear()
         await update.message.reply_text(
-            "✅ پیام شما ارسال شد.\nبرای ارسال پیام جدید یکی از بخش‌های زیر را انتخاب کنید:",
+            "✅ پیام شما ثبت شد و برای پشتیبانی ارسال می‌شود.\nبرای ارسال پیام جدید یکی از بخش‌های زیر را انتخاب کنید:",
             reply_markup=keyboard
         )
         return ConversationHandler.END
@@ -145,35 +616,115 @@ async def get_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await handle_conversation_end(update, context)
     
     if update.message.text:
-        context.user_data.setdefault("messages", []).append(("متن", update.message.text))
+        item = ("متن", update.message.text)
     elif update.message.photo:
         file_id = update.message.photo[-1].file_id
         caption = update.message.caption or ""
-        context.user_data.setdefault("messages", []).append(("عکس", file_id, caption))
+        item = ("عکس", file_id, caption)
     elif update.message.voice:
         file_id = update.message.voice.file_id
-        context.user_data.setdefault("messages", []).append(("صوت", file_id))
+        item = ("صوت", file_id)
     elif update.message.document:
         file_id = update.message.document.file_id
         filename = update.message.document.file_name or "فایل"
-        context.user_data.setdefault("messages", []).append(("فایل", file_id, filename))
+        item = ("فایل", file_id, filename)
     else:
         await update.message.reply_text(
             "❌ لطفا متن، عکس، ویس یا فایل بفرستید یا روی «📤 ارسال پیام» بزنید."
         )
         return GET_MESSAGE
 
-    
-    
-    await update.message.reply_text(
-        "✅ پیام دریافت شد! می‌تونید پیام‌های بیشتری بفرستید یا روی «📤 ارسال پیام» بزنید.",
-        reply_markup=action_keyboard
-    )
+    messages = context.user_data.setdefault("messages", [])
+    group_id = update.message.media_group_id
+    if group_id:
+        # Album items arrive as separate updates; keep them in one entry so they are relayed as an album
+        album = next((m for m in reversed(messages) if m[0] == "آلبوم" and m[1] == group_id), None)
+        if album is None:
+            messages.append(("آلبوم", group_id, [item]))
+        else:
+            album[2].append(item)
+    else:
+        messages.append(item)
+
+    # One acknowledgement per burst (an album, or several quick messages) instead of one per update
+    user_data = context.user_data
+    user_data["unacked"] = user_data.get("unacked", 0) + 1
+    bot = context.bot
+    chat_id = update.effective_chat.id
+
+    async def acknowledge():
+        count = user_data.pop("unacked", 0)
+        if not count:
+            return
+        received = "✅ پیام دریافت شد!" if count == 1 else f"✅ {count} پیام دریافت شد!"
+        try:
+            await bot.send_message(
+                chat_id,
+                f"{received} می‌تونید پیام‌های بیشتری بفرستید یا روی «📤 ارسال پیام» بزنید.",
+                reply_markup=action_keyboard
+            )
+        except TelegramError as e:
+            logger.error(f"Error acknowledging messages from {chat_id}: {e}")
+
+    context.bot_data["debouncer"].schedule(f"ack:{chat_id}", acknowledge, ACK_DEBOUNCE_MS / 1000)
     return GET_MESSAGE
 
+def ticket_message_calls(messages: List) -> List[tuple]:
+    """Bot API calls (method, kwargs) that relay the messages of a ticket, for the outbox"""
+    calls = []
+    for i, m in enumerate(messages, 1):
+        if m[0] == "متن":
+            calls.append(("send_message", {"text": f"📝 *پیام {i}:*\n{m[1]}", "parse_mode": "Markdown"}))
+        elif m[0] == "عکس":
+            cap = f"🖼️ *تصویر {i}*" + (f"\n📝 {m[2]}" if len(m) > 2 and m[2] else "")
+            calls.append(("send_photo", {"photo": m[1], "caption": cap, "parse_mode": "Markdown"}))
+        elif m[0] == "صوت":
+            calls.append(("send_voice", {"voice": m[1], "caption": f"🎤 *پیام صوتی {i}*", "parse_mode": "Markdown"}))
+        elif m[0] == "فایل":
+            filename = m[2] if len(m) > 2 else "فایل"
+            calls.append(("send_document", {"document": m[1], "caption": f"📄 *فایل {i}: {filename}*", "parse_mode": "Markdown"}))
+        elif m[0] == "آلبوم":
+            media = []
+            for j, item in enumerate(m[2]):
+                text = item[2] if len(item) > 2 else ""
+                if item[0] == "عکس":
+                    cap = f"📝 {text}" if text else ""
+                    if j == 0:
+                        cap = f"🗂️ *آلبوم {i}* ({len(m[2])} مورد)" + (f"\n{cap}" if cap else "")
+                    media.append({"type": "photo", "media": item[1], "caption": cap, "parse_mode": "Markdown"})
+                else:
+                    cap = f"📄 {text or 'فایل'}"
+                    if j == 0:
+                        cap = f"🗂️ *آلبوم {i}* ({len(m[2])} مورد)\n{cap}"
+                    media.append({"type": "document", "media": item[1], "caption": cap, "parse_mode": "Markdown"})
+            # Telegram albums hold 2 to 10 items, the same limits the client uploads with;
+            # a chunk of one (an 11th photo, say) goes out as a plain photo or document
+            for start in range(0, len(media), 10):
+                chunk = media[start:start + 10]
+                if len(chunk) > 1:
+                    calls.append(("send_media_group", {"media": chunk}))
+                elif chunk[0]["type"] == "photo":
+                    calls.append(("send_photo", {"photo": chunk[0]["media"], "caption": chunk[0]["caption"], "parse_mode": "Markdown"}))
+                else:
+                    calls.append(("send_document", {"document": chunk[0]["media"], "caption": chunk[0]["caption"], "parse_mode": "Markdown"}))
+    return calls
+
+def input_media(item: Dict):
+    """InputMedia for an album item the outbox stored as a dict"""
+    media_class = InputMediaPhoto if item["type"] == "photo" else InputMediaDocument
+    return media_class(item["media"], caption=item.get("caption"), parse_mode=item.get("parse_mode"))
+
+def enqueue_ticket(context: ContextTypes.DEFAULT_TYPE, chat_id: str, key: str, header: str, messages: List,
+                   route: Optional[str] = None) -> None:
+    """Queue a ticket's header and messages for chat_id, in order"""
+    outbox_send(context, "send_message", chat_id, key=f"{key}:header", route=route, text=header, parse_mode="Markdown")
+    for i, (method, kwargs) in enumerate(ticket_message_calls(messages)):
+        outbox_send(context, method, chat_id, key=f"{key}:{i}", route=route, **kwargs)
+
 async def send_to_primary_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send user message to primary admins with delegation options"""
-    if not PRIMARY_ADMINS:
+    config = get_config(context)
+    if not config.primary_admins:
         return
     
     user = update.message.from_user
@@ -194,121 +745,303 @@ async def send_to_primary_admins(update: Update, context: ContextTypes.DEFAULT_T
         "username": username,
         "section": section,
         "messages": messages,
-        "date": date
+        "date": date,
+        "created_at": time.time()
     }
+    context.bot_data["ticket_queue"].push(message_id, context.bot_data["pending_messages"][message_id])
+    record_ticket_event(context.bot_data, "created", message_id, context.bot_data["pending_messages"][message_id])
+    for m in messages:
+        for item in (m[2] if m[0] == "آلبوم" else [m]):
+            record_transcript(context, message_id, "user", draft_record(item))
     
     header = (
         f"📩 *پیام جدید از کاربر*\n\n"
-        f"📛 یوزرنیم: {username}\n"
+        f"📛 یوزرنیم: {escape_markdown(username)}\n"
         f"🆔 شناسه: `{user.id}`\n"
         f"🗓️ تاریخ: {date}\n"
         f"📂 بخش: {section}\n"
         f"📊 تعداد پیام‌ها: {len(messages)}\n\n"
     )
     
-    delegation_keyboard = create_delegation_keyboard(message_id)
-    
-    for admin_id in PRIMARY_ADMINS:
-        try:
-            await context.bot.send_message(admin_id, header, parse_mode="Markdown")
-            
-            for i, m in enumerate(messages, 1):
-                if m[0] == "متن":
-                    await context.bot.send_message(admin_id, f"📝 *پیام {i}:*\n{m[1]}", parse_mode="Markdown")
-                elif m[0] == "عکس":
-                    cap = f"🖼️ *تصویر {i}*" + (f"\n📝 {m[2]}" if len(m) > 2 and m[2] else "")
-                    await context.bot.send_photo(admin_id, m[1], caption=cap, parse_mode="Markdown")
-                elif m[0] == "صوت":
-                    await context.bot.send_voice(admin_id, m[1], caption=f"🎤 *پیام صوتی {i}*", parse_mode="Markdown")
-                elif m[0] == "فایل":
-                    filename = m[2] if len(m) > 2 else "فایل"
-                    await context.bot.send_document(admin_id, m[1], caption=f"📄 *فایل {i}: {filename}*", parse_mode="Markdown")
-            
-            await context.bot.send_message(
-                admin_id, 
-                "👥 این پیام را به کدام ادمین ارجاع می‌دهید؟",
-                reply_markup=delegation_keyboard
+    delegation_keyboard = create_delegation_keyboard(config, message_id)
+    
+    # Through the outbox, so flood control or a failing call delays the ticket instead of losing it;
+    # the keyboard's message ID is recorded on delivery by on_outbox_delivery
+    for admin_id in config.primary_admins:
+        key = f"{update.update_id}:intake:{admin_id}"
+        enqueue_ticket(context, admin_id, key, header, messages)
+        outbox_send(
+            context, "send_message", admin_id, key=f"{key}:keyboard", keyboard=message_id,
+            text="👥 این پیام را به کدام ادمین ارجاع می‌دهید؟",
+            reply_markup=delegation_keyboard.to_dict()
+        )
+
+def ticket_created_at(ticket: Dict) -> float:
+    """Creation time as a timestamp; tickets from before created_at have only the minute"""
+    if "created_at" in ticket:
+        return ticket["created_at"]
+    return datetime.strptime(ticket["date"], "%Y-%m-%d %H:%M").timestamp()
+
+def is_unassigned(ticket: Optional[Dict]) -> bool:
+    return ticket is not None and not ticket.get("delegated_to") and not ticket.get("completed")
+
+class TicketQueue:
+    """Unassigned tickets waiting for /next, oldest first, one heap per section
+
+    Tickets that get delegated or closed some other way are not searched for
+    and removed; they are dropped when they surface at the top of a heap.
+    """
+
+    def __init__(self):
+        self.heaps: Dict[str, List[tuple]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(heap) for heap in self.heaps.values())
+
+    def push(self, ticket_id: str, ticket: Dict) -> None:
+        heapq.heappush(self.heaps.setdefault(ticket["section"], []), (ticket_created_at(ticket), ticket_id))
+
+    def sections(self, section: Optional[str] = None) -> List[str]:
+        """Sections whose name contains `section` (as /export matches them), or all of them"""
+        return [name for name in self.heaps if not section or section in name]
+
+    def pop(self, tickets: Dict, section: Optional[str] = None) -> Optional[str]:
+        """The oldest unassigned ticket, in sections matching `section` or in any section"""
+        best = None
+        for name in self.sections(section):
+            heap = self.heaps[name]
+            while heap and not is_unassigned(tickets.get(heap[0][1])):
+                heapq.heappop(heap)
+            if heap and (best is None or heap[0] < self.heaps[best][0]):
+                best = name
+        if best is None:
+            return None
+        return heapq.heappop(self.heaps[best])[1]
+
+def update_ticket(bot_data: Dict, ticket: Dict, **fields) -> None:
+    """Change ticket fields and mark the tickets for the next snapshot"""
+    ticket.update(fields)
+    bot_data["tickets_dirty"] = True
+
+def claim_ticket(ticket: Dict, admin_id: str, claimed_by: str) -> bool:
+    """Assign an unassigned ticket to admin_id; False if someone else got it first
+
+    Check and assignment happen without an await in between, so of two
+    admins claiming the same ticket exactly one wins.
+    """
+    if not is_unassigned(ticket):
+        return False
+    ticket["delegated_to"] = admin_id
+    ticket["delegated_by"] = claimed_by
+    ticket["delegation_time"] = datetime.now().strftime("%Y-%m-%d %H:%M")
+    ticket["conversation_active"] = True
+    return True
+
+def release_ticket(bot_data: Dict, ticket_id: str, ticket: Dict, reason: str) -> None:
+    """Undo a claim: the ticket is unassigned again and waits in the queue and the index
+
+    Its old delegation keyboards already say who took it, so the primary
+    admins get a new one, headed by reason.
+    """
+    config = bot_data["config"]
+    index = bot_data["ticket_index"]
+    index.delegated.discard(ticket_id)
+    index.load.get(ticket.get("delegated_to"), set()).discard(ticket_id)
+    index.new.add(ticket_id)
+    ticket.pop("delegated_at", None)
+    update_ticket(
+        bot_data, ticket,
+        delegated_to=None, delegated_by=None, delegation_time=None, conversation_active=False
+    )
+    bot_data["ticket_queue"].push(ticket_id, ticket)
+
+    markup = create_delegation_keyboard(config, ticket_id).to_dict()
+    version = time.time_ns()
+    for admin_id in config.primary_admins:
+        bot_data["outbox"].enqueue(
+            config.name, "send_message", admin_id, key=f"release:{ticket_id}:{admin_id}:{version}",
+            keyboard=ticket_id, reply_markup=markup,
+            text=(
+                f"♻️ {reason}\n"
+                f"تیکت کاربر {ticket['user_id']} (بخش: {ticket.get('section', 'نامشخص')}) دوباره بی‌صاحب است.\n"
+                f"👥 آن را به کدام ادمین ارجاع می‌دهید؟"
             )
-            
-        except TelegramError as e:
-            logger.error(f"Error sending to primary admin {admin_id}: {e}")
+        )
+
+    dashboard = bot_data.get("dashboard")
+    if dashboard is not None:
+        dashboard.publish(config.name, {
+            "event": "released",
+            "ticket": ticket_id,
+            "section": ticket.get("section"),
+            "time": datetime.now().isoformat(timespec="seconds"),
+        })
+
+def delegation_status_text(config: BotConfig, ticket: Dict) -> str:
+    """What replaces a delegation keyboard once the ticket is taken"""
+    if not ticket.get("delegated_to"):
+        return "✅ این تیکت بسته شد."
+    if ticket["delegated_by"] == ticket["delegated_to"]:
+        return f"✅ {config.admin_name(ticket['delegated_to'])} این تیکت را از صف برداشت."
+    return (
+        f"✅ این پیام توسط {config.admin_name(ticket['delegated_by'])} "
+        f"به {config.admin_name(ticket['delegated_to'])} ارجاع داده شد."
+    )
+
+async def sync_delegation_keyboards(context: ContextTypes.DEFAULT_TYPE, ticket: Dict,
+                                    except_admin: Optional[str] = None) -> None:
+    """Replace the delegation keyboards primary admins still see with who took the ticket, all at once"""
+    keyboards = ticket.pop("keyboards", {})
+    context.bot_data["tickets_dirty"] = True
+    text = delegation_status_text(get_config(context), ticket)
+
+    targets = [(admin_id, message_id) for admin_id, message_id in keyboards.items() if admin_id != except_admin]
+    results = await asyncio.gather(
+        *(context.bot.edit_message_text(text, chat_id=admin_id, message_id=message_id) for admin_id, message_id in targets),
+        return_exceptions=True
+    )
+    for (admin_id, _), result in zip(targets, results):
+        if isinstance(result, TelegramError):
+            logger.error(f"Error updating delegation keyboard of {admin_id}: {result}")
+
+def send_ticket_to_admin(context: ContextTypes.DEFAULT_TYPE, message_id: str, admin_id: str, title: str) -> None:
+    """Queue an assigned ticket with answering instructions for its secondary admin"""
+    message_data = context.bot_data["pending_messages"][message_id]
+    header = (
+        f"{title}\n\n"
+        f"📛 یوزرنیم کاربر: {escape_markdown(message_data['username'])}\n"
+        f"🆔 شناسه کاربر: `{message_data['user_id']}`\n"
+        f"🗓️ تاریخ پیام: {message_data['date']}\n"
+        f"📂 بخش: {message_data['section']}\n"
+        f"📊 تعداد پیام‌ها: {len(message_data['messages'])}\n"
+        f"⏰ زمان ارجاع: {message_data['delegation_time']}\n\n"
+        f"📝 *نحوه پاسخ:*\n"
+        f"برای پاسخ، پیام خود را به این شکل بنویسید:\n"
+        f"`{message_data['user_id']}: متن پاسخ`\n\n"
+        f"💡 *نکته:* پس از پاسخ اول، می‌توانید مستقیماً با کاربر صحبت کنید.\n"
+        f"برای پایان مکالمه از دستور `/endchat {message_data['user_id']}` استفاده کنید."
+    )
+
+    # Routed, so the admin can answer by replying to any of these messages
+    key = f"ticket:{message_id}:{admin_id}:{message_data['delegation_time']}"
+    enqueue_ticket(context, admin_id, key, header, message_data["messages"], route=message_id)
+
+async def next_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Claim the oldest unassigned ticket, optionally from one section (Secondary admins only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+
+    if user_id not in config.secondary_admins:
+        await update.message.reply_text("❌ شما مجاز به استفاده از این دستور نیستید.")
+        return
+
+    section = " ".join(context.args) if context.args else None
+    if section and not context.bot_data["ticket_queue"].sections(section):
+        sections = "، ".join(context.bot_data["ticket_queue"].heaps) or "-"
+        await update.message.reply_text(f"❌ بخش «{section}» در صف نیست.\nبخش‌ها: {sections}")
+        return
+
+    pending_messages = context.bot_data.get("pending_messages", {})
+    message_id = context.bot_data["ticket_queue"].pop(pending_messages, section)
+    if message_id is None or not claim_ticket(pending_messages[message_id], user_id, user_id):
+        await update.message.reply_text("📭 در حال حاضر تیکت بی‌صاحبی در صف نیست.")
+        return
+    ticket = pending_messages[message_id]
+    record_ticket_event(context.bot_data, "delegated", message_id, ticket, user_id)
+
+    try:
+        await sync_delegation_keyboards(context, ticket)
+        send_ticket_to_admin(context, message_id, user_id, "📥 *تیکت از صف انتظار*")
+    except Exception as e:
+        # Give the ticket back rather than leave it claimed by an admin who never got it
+        logger.error(f"Error sending queued ticket {message_id} to {user_id}: {e}")
+        release_ticket(
+            context.bot_data, message_id, ticket, f"ارسال تیکت به {config.admin_name(user_id)} انجام نشد."
+        )
+        await update.message.reply_text("❌ ارسال تیکت انجام نشد و تیکت به صف برگشت. لطفا دوباره /next بزنید.")
 
 async def handle_delegation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle delegation callback from primary admins"""
+    config = get_config(context)
     query = update.callback_query
     user_id = str(query.from_user.id)
     
-    if user_id not in PRIMARY_ADMINS:
+    if user_id not in config.primary_admins:
         await query.answer("❌ شما مجاز به انجام این عملیات نیستید.")
         return
     
-    await query.answer()
-    
     try:
         _, target_admin_id, message_id = query.data.split("_", 2)
     except ValueError:
+        await query.answer()
         await query.edit_message_text("❌ خطا در پردازش درخواست.")
         return
     
+    if target_admin_id not in config.secondary_admins:
+        # A keyboard sent before this admin was removed from the admin file
+        await query.answer("❌ این ادمین دیگر در فهرست پشتیبان‌ها نیست.", show_alert=True)
+        return
+    
+    await query.answer()
+    
     pending_messages = context.bot_data.get("pending_messages", {})
     if message_id not in pending_messages:
         await query.edit_message_text("❌ پیام مورد نظر یافت نشد.")
         return
     
     message_data = pending_messages[message_id]
-    target_admin_name = get_admin_name(target_admin_id)
-    delegating_admin_name = get_admin_name(user_id)
-    
-    message_data["delegated_to"] = target_admin_id
-    message_data["delegated_by"] = user_id
-    message_data["delegation_time"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-    message_data["conversation_active"] = True 
-    
-    await query.edit_message_text(f"✅ پیام با موفقیت به {target_admin_name} ارجاع داده شد.")
+    target_admin_name = config.admin_name(target_admin_id)
+    delegating_admin_name = config.admin_name(user_id)
+    
+    if not claim_ticket(message_data, target_admin_id, user_id):
+        # Another primary admin (or a /next) got there first
+        if message_data.get("delegated_to"):
+            await query.edit_message_text(
+                f"⚠️ این پیام قبلاً به {config.admin_name(message_data['delegated_to'])} ارجاع داده شده است."
+            )
+        else:
+            await query.edit_message_text("⚠️ این پیام قبلاً بسته شده است.")
+        return
+    record_ticket_event(context.bot_data, "delegated", message_id, message_data, target_admin_id)
     
-    try:
-        header = (
-            f"📬 *پیام ارجاعی از {delegating_admin_name}*\n\n"
-            f"📛 یوزرنیم کاربر: {message_data['username']}\n"
-            f"🆔 شناسه کاربر: `{message_data['user_id']}`\n"
-            f"🗓️ تاریخ پیام: {message_data['date']}\n"
-            f"📂 بخش: {message_data['section']}\n"
-            f"📊 تعداد پیام‌ها: {len(message_data['messages'])}\n"
-            f"⏰ زمان ارجاع: {message_data['delegation_time']}\n\n"
-            f"📝 *نحوه پاسخ:*\n"
-            f"برای پاسخ، پیام خود را به این شکل بنویسید:\n"
-            f"`{message_data['user_id']}: متن پاسخ`\n\n"
-            f"💡 *نکته:* پس از پاسخ اول، می‌توانید مستقیماً با کاربر صحبت کنید.\n"
-            f"برای پایان مکالمه از دستور `/endchat {message_data['user_id']}` استفاده کنید."
-        )
-        
-        await context.bot.send_message(target_admin_id, header, parse_mode="Markdown")
-        
-        for i, m in enumerate(message_data['messages'], 1):
-            if m[0] == "متن":
-                await context.bot.send_message(target_admin_id, f"📝 *پیام {i}:*\n{m[1]}", parse_mode="Markdown")
-            elif m[0] == "عکس":
-                cap = f"🖼️ *تصویر {i}*" + (f"\n📝 {m[2]}" if len(m) > 2 and m[2] else "")
-                await context.bot.send_photo(target_admin_id, m[1], caption=cap, parse_mode="Markdown")
-            elif m[0] == "صوت":
-                await context.bot.send_voice(target_admin_id, m[1], caption=f"🎤 *پیام صوتی {i}*", parse_mode="Markdown")
-            elif m[0] == "فایل":
-                filename = m[2] if len(m) > 2 else "فایل"
-                await context.bot.send_document(target_admin_id, m[1], caption=f"📄 *فایل {i}: {filename}*", parse_mode="Markdown")
-        
-    except TelegramError as e:
-        logger.error(f"Error sending to secondary admin {target_admin_id}: {e}")
-        await context.bot.send_message(
-            user_id, 
-            f"❌ خطا در ارسال پیام به {target_admin_name}. لطفا دوباره تلاش کنید."
-        )
+    # Queued before anything can fail: the ticket is claimed now
+    send_ticket_to_admin(context, message_id, target_admin_id, f"📬 *پیام ارجاعی از {delegating_admin_name}*")
+    outbox_send(
+        context, "edit_message_text", user_id, key=f"{update.update_id}:delegated",
+        message_id=query.message.message_id, text=f"✅ پیام با موفقیت به {target_admin_name} ارجاع داده شد."
+    )
+    await sync_delegation_keyboards(context, message_data, except_admin=user_id)
+
+def answer_ticket(context: ContextTypes.DEFAULT_TYPE, update: Update, message_id: str, ticket: Dict,
+                  admin_id: str, reply_content: str) -> None:
+    """Queue the support header for an admin's reply and mark the ticket answered and its conversation active"""
+    outbox_send(
+        context,
+        "send_message",
+        ticket["user_id"],
+        key=f"{update.update_id}:header",
+        text=(
+            f"💬 *پاسخ تیم پشتیبانی کلاب مالی آرکاکوین*\n\n"
+            f"📂 بخش: {ticket['section']}\n"
+        ),
+        parse_mode="Markdown"
+    )
+    if not ticket.get("admin_reply"):
+        record_ticket_event(context.bot_data, "answered", message_id, ticket, admin_id)
+    update_ticket(
+        context.bot_data, ticket,
+        conversation_active=True,
+        admin_reply=reply_content,
+        first_reply_time=datetime.now().strftime("%Y-%m-%d %H:%M")
+    )
 
 async def handle_admin_direct_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle direct replies from secondary admins in format: user_id: message"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     text = update.message.text or ""
 
-    if user_id not in SECONDARY_ADMINS:
+    if user_id not in config.secondary_admins:
         return
 
     if ":" not in text:
@@ -347,34 +1080,17 @@ async def handle_admin_direct_reply(update: Update, context: ContextTypes.DEFAUL
         )
         return
     
-    try:
-        await context.bot.send_message(
-            target_user_id,
-            f"💬 *پاسخ تیم پشتیبانی کلاب مالی آرکاکوین*\n\n"
-            f"📂 بخش: {user_message_data['section']}\n",
-            parse_mode="Markdown"
-        )
-        
-        await context.bot.send_message(target_user_id, reply_content)
-        
-        user_message_data["conversation_active"] = True
-        user_message_data["admin_reply"] = reply_content
-        user_message_data["first_reply_time"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-        
-        admin_name = get_admin_name(user_id)
-        await update.message.reply_text(
-            f"✅ پاسخ ارسال شد و مکالمه با کاربر `{target_user_id}` فعال شد.\n"
-            f"اکنون می‌توانید مستقیماً پیام بفرستید.\n"
-            f"برای پایان مکالمه از /endchat استفاده کنید.",
-            parse_mode="Markdown"
-        )
-        
-    except TelegramError as e:
-        logger.error(f"Error sending reply to user {target_user_id}: {e}")
-        await update.message.reply_text(
-            f"❌ خطا در ارسال پاسخ به کاربر `{target_user_id}`.",
-            parse_mode="Markdown"
-        )
+    # Delivery happens in the outbox, which retries and dead-letters failed sends itself
+    answer_ticket(context, update, message_id, user_message_data, user_id, reply_content)
+    outbox_send(context, "send_message", target_user_id, key=f"{update.update_id}:reply", text=reply_content)
+    record_transcript(context, message_id, user_id, {"kind": "text", "text": reply_content})
+    
+    await update.message.reply_text(
+        f"📤 پاسخ در صف ارسال قرار گرفت و مکالمه با کاربر `{target_user_id}` فعال شد.\n"
+        f"اکنون می‌توانید مستقیماً پیام بفرستید.\n"
+        f"برای پایان مکالمه از /endchat استفاده کنید.",
+        parse_mode="Markdown"
+    )
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel current conversation"""
@@ -387,8 +1103,9 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def list_pending_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List pending messages (Primary admins only)"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
-    if user_id not in PRIMARY_ADMINS:
+    if user_id not in config.primary_admins:
         return
     
     pending_messages = context.bot_data.get("pending_messages", {})
@@ -399,7 +1116,7 @@ async def list_pending_messages(update: Update, context: ContextTypes.DEFAULT_TY
     msg = "📋 *پیام‌های در انتظار:*\n\n"
     for msg_id, data in pending_messages.items():
         status = "✅ تکمیل شده" if data.get("completed") else "⏳ در انتظار"
-        delegated_to = get_admin_name(data.get("delegated_to", "")) if data.get("delegated_to") else "ارجاع نشده"
+        delegated_to = config.admin_name(data.get("delegated_to", "")) if data.get("delegated_to") else "ارجاع نشده"
         
         msg += (
             f"🆔 `{data['user_id']}`\n"
@@ -414,8 +1131,9 @@ async def list_pending_messages(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def list_my_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List tasks assigned to secondary admin"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
-    if user_id not in SECONDARY_ADMINS:
+    if user_id not in config.secondary_admins:
         return
     
     pending_messages = context.bot_data.get("pending_messages", {})
@@ -426,7 +1144,7 @@ async def list_my_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("📭 شما هیچ تسک در انتظاری ندارید.")
         return
     
-    admin_name = get_admin_name(user_id)
+    admin_name = config.admin_name(user_id)
     my_messages = [data for data in pending_messages.values() 
                 if data.get("delegated_to") == user_id]
     total = len(my_messages)
@@ -453,9 +1171,10 @@ async def list_my_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_conversation_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle conversation end for secondary admins"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id not in SECONDARY_ADMINS:
+    if user_id not in config.secondary_admins:
         return
     
     pending_messages = context.bot_data.get("pending_messages", {})
@@ -474,13 +1193,18 @@ async def handle_conversation_end(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("❌ هیچ مکالمه فعالی برای اتمام یافت نشد.")
         return
     
-    active_conversation["completed"] = True
-    active_conversation["completed_by"] = user_id
-    active_conversation["completion_time"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-    active_conversation["conversation_active"] = False
-    active_conversation["end_reason"] = "admin_ended"
+    update_ticket(
+        context.bot_data, active_conversation,
+        completed=True,
+        completed_by=user_id,
+        completion_time=datetime.now().strftime("%Y-%m-%d %H:%M"),
+        conversation_active=False,
+        end_reason="admin_ended"
+    )
+    record_ticket_event(context.bot_data, "completed", message_id, active_conversation, user_id)
+    settle_relay_burst(context, message_id)
     
-    admin_name = get_admin_name(user_id)
+    admin_name = config.admin_name(user_id)
     target_user_id = active_conversation["user_id"]
     
     try:
@@ -497,13 +1221,13 @@ async def handle_conversation_end(update: Update, context: ContextTypes.DEFAULT_
     completion_message = (
         f"🔚 *مکالمه به پایان رسید*\n\n"
         f"👤 پایان‌دهنده: {admin_name}\n"
-        f"📛 یوزرنیم کاربر: {active_conversation['username']}\n"
+        f"📛 یوزرنیم کاربر: {escape_markdown(active_conversation['username'])}\n"
         f"🆔 شناسه کاربر: `{active_conversation['user_id']}`\n"
         f"📂 بخش: {active_conversation['section']}\n"
         f"⏰ زمان پایان: {active_conversation['completion_time']}\n"
     )
     
-    for admin_id in PRIMARY_ADMINS:
+    for admin_id in config.primary_admins:
         try:
             await context.bot.send_message(admin_id, completion_message, parse_mode="Markdown")
         except TelegramError as e:
@@ -513,49 +1237,105 @@ async def handle_conversation_end(update: Update, context: ContextTypes.DEFAULT_
 
 async def handle_direct_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle direct messages from secondary admins to active conversations"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id not in SECONDARY_ADMINS:
+    if user_id not in config.secondary_admins:
         return
     
     pending_messages = context.bot_data.get("pending_messages", {})
     active_conversation = None
-    
-    for data in pending_messages.values():
-        if (data.get("delegated_to") == user_id and 
-            not data.get("completed") and 
-            data.get("conversation_active")):
+    message_id = None
+
+    reply_to = update.message.reply_to_message
+    if reply_to:
+        mid = context.bot_data["routes"].get(update.message.chat_id, reply_to.message_id)
+        data = pending_messages.get(mid)
+        if data and data.get("delegated_to") == user_id and not data.get("completed"):
             active_conversation = data
-            break
+            message_id = mid
+
+    if not active_conversation:
+        for mid, data in pending_messages.items():
+            if (data.get("delegated_to") == user_id and 
+                not data.get("completed") and 
+                data.get("conversation_active")):
+                active_conversation = data
+                message_id = mid
+                break
     
     if not active_conversation:
         return  
     
     target_user_id = active_conversation["user_id"]
     
-    try:
-        if update.message.text:
-            await context.bot.send_message(target_user_id, reply_content) 
-        elif update.message.photo:
-            await context.bot.send_photo(
-                target_user_id, 
-                update.message.photo[-1].file_id,
-                caption=update.message.caption
-            )
-        elif update.message.voice:
-            await context.bot.send_voice(target_user_id, update.message.voice.file_id)
-        elif update.message.document:
-            await context.bot.send_document(
-                target_user_id, 
-                update.message.document.file_id,
-                caption=update.message.caption
-            )
-        
-        await update.message.reply_text("✅ پیام ارسال شد.")
-        
-    except TelegramError as e:
-        logger.error(f"Error sending direct message to user {target_user_id}: {e}")
-        await update.message.reply_text("❌ خطا در ارسال پیام.")
+    if not active_conversation.get("admin_reply"):
+        # First answer, given by replying to the routed ticket: same as a `user_id: text` reply
+        answer_ticket(
+            context, update, message_id, active_conversation, user_id,
+            update.message.text or update.message.caption or "📎"
+        )
+    enqueue_relay(context, target_user_id, update.message, key=f"{update.update_id}:relay")
+    record_transcript(context, message_id, user_id, message_record(update.message))
+    
+    await update.message.reply_text("📤 پیام در صف ارسال قرار گرفت.")
+
+def enqueue_relay(context: ContextTypes.DEFAULT_TYPE, chat_id: str, message, key: str,
+                  route: Optional[str] = None) -> None:
+    """Queue a copy of a text/photo/voice/document message for delivery to chat_id"""
+    if message.text:
+        outbox_send(context, "send_message", chat_id, key=key, route=route, text=message.text)
+    elif message.photo:
+        outbox_send(context, "send_photo", chat_id, key=key, route=route,
+                    photo=message.photo[-1].file_id, caption=message.caption)
+    elif message.voice:
+        outbox_send(context, "send_voice", chat_id, key=key, route=route, voice=message.voice.file_id)
+    elif message.document:
+        outbox_send(context, "send_document", chat_id, key=key, route=route,
+                    document=message.document.file_id, caption=message.caption)
+
+def flush_relay_burst(context: ContextTypes.DEFAULT_TYPE, ticket_id: str) -> int:
+    """Queue a conversation's buffered text messages as one relayed message; returns how many were merged"""
+    burst = context.bot_data["relay_bursts"].pop(ticket_id, None)
+    if burst is None:
+        return 0
+
+    # Usernames may hold "_", which would open an italic span
+    header = f"💬 *پیام جدید از {escape_markdown(burst['username'])}* (شناسه: `{burst['user_id']}`)\n\n"
+    chunks = [header]
+    for text in burst["texts"]:
+        for piece in split_markdown(escape_markdown(text), RELAY_MESSAGE_LIMIT):
+            if len(chunks[-1]) + len(piece) + 2 > RELAY_MESSAGE_LIMIT:
+                chunks.append("")
+            chunks[-1] += piece + "\n\n"
+    for i, chunk in enumerate(chunks):
+        outbox_send(
+            context, "send_message", burst["admin"], key=f"{burst['update_id']}:burst:{i}", route=ticket_id,
+            text=chunk.strip(), parse_mode="Markdown"
+        )
+    return len(burst["texts"])
+
+def split_markdown(text: str, limit: int) -> List[str]:
+    """Split escaped Markdown into pieces of at most limit characters, preferably at line breaks
+
+    A cut never separates a backslash from the character it escapes.
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut == -1:
+            cut = limit
+            if text[cut - 1] == "\\" and text[cut] in "_*`[":
+                cut -= 1
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    pieces.append(text)
+    return pieces
+
+def settle_relay_burst(context: ContextTypes.DEFAULT_TYPE, ticket_id: str) -> None:
+    """Relay a conversation's still-buffered texts now, before the conversation ends"""
+    context.bot_data["debouncer"].cancel(f"relay:{ticket_id}")
+    flush_relay_burst(context, ticket_id)
 
 async def handle_user_active_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle messages from users who have active conversations"""
@@ -564,76 +1344,316 @@ async def handle_user_active_conversation(update: Update, context: ContextTypes.
     pending_messages = context.bot_data.get("pending_messages", {})
     active_conversation = None
     assigned_admin = None
+    message_id = None
     
-    for data in pending_messages.values():
+    for mid, data in pending_messages.items():
         if (data["user_id"] == user_id and 
             not data.get("completed") and 
             data.get("conversation_active")):
             active_conversation = data
             assigned_admin = data.get("delegated_to")
+            message_id = mid
             break
     
     if not active_conversation or not assigned_admin:
         return False  
     
-    try:
-        admin_name = get_admin_name(assigned_admin)
-        username = f"@{update.message.from_user.username}" if update.message.from_user.username else "بدون یوزرنیم"
-        
-        header = f"💬 *پیام جدید از {username}* (شناسه: `{user_id}`)\n\n"
-        await context.bot.send_message(assigned_admin, header, parse_mode="Markdown")
-        
-        if update.message.text:
-            await context.bot.send_message(assigned_admin, update.message.text)
-        elif update.message.photo:
-            await context.bot.send_photo(
-                assigned_admin, 
-                update.message.photo[-1].file_id,
-                caption=update.message.caption
-            )
-        elif update.message.voice:
-            await context.bot.send_voice(assigned_admin, update.message.voice.file_id)
-        elif update.message.document:
-            await context.bot.send_document(
-                assigned_admin, 
-                update.message.document.file_id,
-                caption=update.message.caption
-            )
-        
-        await update.message.reply_text("✅ پیام شما به پشتیبان ارسال شد.")
-        return True 
-        
-    except TelegramError as e:
-        logger.error(f"Error forwarding to admin {assigned_admin}: {e}")
-        return False
+    username = f"@{update.message.from_user.username}" if update.message.from_user.username else "بدون یوزرنیم"
+    record_transcript(context, message_id, "user", message_record(update.message))
+    debouncer = context.bot_data["debouncer"]
+    bursts = context.bot_data["relay_bursts"]
 
-async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """End conversation with specific user ID"""
-    user_id = str(update.message.from_user.id)
-    
-    if user_id not in SECONDARY_ADMINS:
-        await update.message.reply_text("❌ شما مجاز به استفاده از این دستور نیستید.")
-        return
-    
-    if not context.args:
-        await update.message.reply_text(
-            "📝 *نحوه استفاده:*\n"
-            "`/endchat شناسه_کاربر`\n\n"
-            "*مثال:*\n"
-            "`/endchat 123456789`",
-            parse_mode="Markdown"
+    if update.message.text:
+        # Consecutive texts are merged into one relayed message and one acknowledgement
+        burst = bursts.setdefault(message_id, {
+            "admin": assigned_admin, "user_id": user_id, "username": username,
+            "update_id": update.update_id, "texts": []
+        })
+        burst["texts"].append(update.message.text)
+        chat_id = update.effective_chat.id
+
+        async def relay_burst():
+            if flush_relay_burst(context, message_id):
+                try:
+                    await context.bot.send_message(chat_id, RELAY_ACK_TEXT)
+                except TelegramError as e:
+                    logger.error(f"Error acknowledging relayed messages to {chat_id}: {e}")
+
+        debouncer.schedule(
+            f"relay:{message_id}", relay_burst, RELAY_COALESCE_MS / 1000, max_delay=RELAY_MAX_DELAY_MS / 1000
         )
-        return
-    
-    target_user_id = context.args[0].strip()
-    
-    pending_messages = context.bot_data.get("pending_messages", {})
-    active_conversation = None
-    message_id = None
+        return True
+
+    # Media is relayed right away, after any texts still buffered so the order is kept
+    settle_relay_burst(context, message_id)
+    header = f"💬 *پیام جدید از {escape_markdown(username)}* (شناسه: `{user_id}`)\n\n"
+    outbox_send(
+        context, "send_message", assigned_admin, key=f"{update.update_id}:header", route=message_id,
+        text=header, parse_mode="Markdown"
+    )
+    enqueue_relay(context, assigned_admin, update.message, key=f"{update.update_id}:relay", route=message_id)
     
-    for mid, data in pending_messages.items():
-        if (data["user_id"] == target_user_id and 
-            data.get("delegated_to") == user_id and
+    await update.message.reply_text(RELAY_ACK_TEXT)
+    return True
+
+class TranscriptLog:
+    """Segmented, append-only log of every relayed message
+
+    Records are JSON lines in DATA_DIR/<namespace>/transcripts/NNNNNN.log,
+    rolled over every TRANSCRIPT_SEGMENT_BYTES. The in-memory index maps each
+    ticket to the (segment, offset, length) of its records and is journaled
+    to index.log, so /history reads only the slices it shows, via mmap.
+    Appends are buffered and written by flush() in a worker thread.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index: Dict[str, List[List[int]]] = {}
+        self.segment = 1
+        self.segment_size = 0  # including buffered records
+        self.buffer: List[tuple] = []
+        self.index_buffer: List[str] = []
+        # Held across a write and by readers, so segments are never written by two threads or read half-written
+        self.lock = asyncio.Lock()
+
+    def segment_path(self, segment: int) -> str:
+        return data_path(os.path.join(self.directory, f"{segment:06d}.log"))
+
+    def index_path(self) -> str:
+        return data_path(os.path.join(self.directory, "index.log"))
+
+    def append(self, ticket_id: str, record: Dict) -> None:
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        if self.segment_size and self.segment_size + len(data) > TRANSCRIPT_SEGMENT_BYTES:
+            self.segment += 1
+            self.segment_size = 0
+        location = [self.segment, self.segment_size, len(data)]
+        self.segment_size += len(data)
+        self.index.setdefault(ticket_id, []).append(location)
+        self.buffer.append((self.segment, data))
+        self.index_buffer.append(f"{ticket_id} {location[0]} {location[1]} {location[2]}\n")
+
+    async def flush(self) -> None:
+        async with self.lock:
+            await self.write_buffered()
+
+    async def write_buffered(self) -> None:
+        """Write out the buffers; the caller holds self.lock"""
+        if not self.buffer:
+            return
+        buffer, self.buffer = self.buffer, []
+        index_lines, self.index_buffer = self.index_buffer, []
+        await asyncio.to_thread(self.write, buffer, index_lines)
+
+    def write(self, buffer: List[tuple], index_lines: List[str]) -> None:
+        """Append buffered records to their segments, then their index lines"""
+        segment, chunk = None, []
+        for record_segment, data in buffer + [(None, b"")]:
+            if record_segment != segment and chunk:
+                with open(self.segment_path(segment), "ab") as f:
+                    f.write(b"".join(chunk))
+                chunk = []
+            segment = record_segment
+            chunk.append(data)
+        with open(self.index_path(), "a", encoding="utf-8") as f:
+            f.writelines(index_lines)
+
+    async def flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(TRANSCRIPT_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.error(f"Error writing transcripts: {e}")
+
+    def load(self) -> None:
+        """Rebuild the index from index.log, re-indexing records written after its last line"""
+        indexed_end: Dict[int, int] = {}
+        try:
+            with open(self.index_path(), encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 4:
+                        continue  # torn last line after a crash
+                    ticket_id, segment, offset, length = parts[0], int(parts[1]), int(parts[2]), int(parts[3])
+                    self.index.setdefault(ticket_id, []).append([segment, offset, length])
+                    indexed_end[segment] = max(indexed_end.get(segment, 0), offset + length)
+        except FileNotFoundError:
+            pass
+
+        directory = os.path.dirname(self.index_path())
+        segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log") and name[:-4].isdigit())
+        last_indexed = max(indexed_end, default=0)
+        recovered = []
+        for segment in segments:
+            if segment < last_indexed:
+                continue
+            recovered += self.reindex_tail(segment, indexed_end.get(segment, 0))
+
+        if recovered:
+            logger.info(f"Re-indexed {len(recovered)} transcript records")
+            with open(self.index_path(), "a", encoding="utf-8") as f:
+                f.writelines(recovered)
+
+        if segments:
+            self.segment = segments[-1]
+            self.segment_size = os.path.getsize(self.segment_path(self.segment))
+
+    def reindex_tail(self, segment: int, start: int) -> List[str]:
+        """Index records of a segment past start; truncate a torn final record"""
+        lines = []
+        path = self.segment_path(segment)
+        with open(path, "r+b") as f:
+            f.seek(start)
+            offset = start
+            for raw in f:
+                try:
+                    if not raw.endswith(b"\n"):
+                        raise ValueError("torn record")
+                    ticket_id = json.loads(raw)["ticket"]
+                except (ValueError, KeyError):
+                    f.truncate(offset)
+                    break
+                self.index.setdefault(ticket_id, []).append([segment, offset, len(raw)])
+                lines.append(f"{ticket_id} {segment} {offset} {len(raw)}\n")
+                offset += len(raw)
+        return lines
+
+    def read(self, locations: List[List[int]]) -> List[Dict]:
+        """Read records at the given locations through mmap; runs in a worker thread"""
+        records = []
+        maps = {}
+        try:
+            for segment, offset, length in locations:
+                if segment not in maps:
+                    with open(self.segment_path(segment), "rb") as f:
+                        maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                records.append(json.loads(maps[segment][offset:offset + length]))
+        finally:
+            for mapped in maps.values():
+                mapped.close()
+        return records
+
+    async def page(self, ticket_ids: List[str], page: int) -> tuple:
+        """Records of one page of the tickets' combined transcript, plus the page count"""
+        async with self.lock:
+            # Records appended during a write are indexed already, so write until nothing is left
+            while self.buffer:
+                await self.write_buffered()
+            locations = [location for ticket_id in ticket_ids for location in self.index.get(ticket_id, [])]
+            pages = max(1, -(-len(locations) // HISTORY_PAGE_SIZE))
+            page = min(max(page, 1), pages)
+            start = (page - 1) * HISTORY_PAGE_SIZE
+            records = await asyncio.to_thread(self.read, locations[start:start + HISTORY_PAGE_SIZE])
+        return records, page, pages
+
+def message_record(message) -> Dict:
+    """Transcript fields of a relayed Telegram message"""
+    if message.text:
+        return {"kind": "text", "text": message.text}
+    if message.photo:
+        return {"kind": "photo", "file_id": message.photo[-1].file_id, "text": message.caption or ""}
+    if message.voice:
+        return {"kind": "voice", "file_id": message.voice.file_id}
+    if message.document:
+        return {"kind": "document", "file_id": message.document.file_id, "text": message.caption or ""}
+    return {"kind": "other"}
+
+def draft_record(m) -> Dict:
+    """Transcript fields of a message collected by get_message"""
+    if m[0] == "متن":
+        return {"kind": "text", "text": m[1]}
+    if m[0] == "عکس":
+        return {"kind": "photo", "file_id": m[1], "text": m[2] if len(m) > 2 else ""}
+    if m[0] == "صوت":
+        return {"kind": "voice", "file_id": m[1]}
+    return {"kind": "document", "file_id": m[1], "text": m[2] if len(m) > 2 else ""}
+
+def record_transcript(context: ContextTypes.DEFAULT_TYPE, ticket_id: str, sender: str, content: Dict) -> None:
+    """Append a relayed message to the ticket's transcript; sender is "user" or an admin ID"""
+    record = {"t": datetime.now().strftime("%Y-%m-%d %H:%M"), "ticket": ticket_id, "from": sender}
+    record.update(content)
+    context.bot_data["transcripts"].append(ticket_id, record)
+
+async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Page through a user's conversation history"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+
+    if user_id not in config.primary_admins and user_id not in config.secondary_admins:
+        await update.message.reply_text("❌ شما مجاز به استفاده از این دستور نیستید.")
+        return
+
+    if not context.args:
+        await update.message.reply_text(
+            "📝 *نحوه استفاده:*\n"
+            "`/history شناسه_کاربر [صفحه]`\n\n"
+            "*مثال:*\n"
+            "`/history 123456789 2`",
+            parse_mode="Markdown"
+        )
+        return
+
+    target_user_id = context.args[0].strip()
+    page = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else 1
+
+    pending_messages = context.bot_data.get("pending_messages", {})
+    tickets = [(data["date"], mid, data) for mid, data in pending_messages.items() if data["user_id"] == target_user_id]
+    if user_id not in config.primary_admins:
+        # Secondary admins only see conversations that were delegated to them
+        tickets = [t for t in tickets if t[2].get("delegated_to") == user_id]
+
+    if not tickets:
+        await update.message.reply_text(f"📭 هیچ مکالمه‌ای برای کاربر {target_user_id} یافت نشد.")
+        return
+
+    ticket_ids = [mid for _, mid, _ in sorted(tickets, key=lambda t: t[0])]
+    records, page, pages = await context.bot_data["transcripts"].page(ticket_ids, page)
+
+    kind_labels = {"photo": "🖼️ تصویر", "voice": "🎤 پیام صوتی", "document": "📄 فایل", "other": "📎 پیام"}
+    msg = f"🗂️ تاریخچه کاربر {target_user_id} (صفحه {page} از {pages})\n\n"
+    for record in records:
+        sender = "👤 کاربر" if record["from"] == "user" else f"🔧 {config.admin_name(record['from'])}"
+        content = record.get("text", "")
+        if record["kind"] != "text":
+            content = f"{kind_labels.get(record['kind'], '📎 پیام')} {content}".strip()
+        if len(content) > HISTORY_TEXT_LIMIT:
+            content = content[:HISTORY_TEXT_LIMIT] + "…"
+        msg += f"[{record['t']}] {sender}:\n{content}\n\n"
+
+    if page < pages:
+        msg += f"صفحه بعد: /history {target_user_id} {page + 1}"
+
+    await update.message.reply_text(msg)
+
+async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """End conversation with specific user ID"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+    
+    if user_id not in config.secondary_admins:
+        await update.message.reply_text("❌ شما مجاز به استفاده از این دستور نیستید.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            "📝 *نحوه استفاده:*\n"
+            "`/endchat شناسه_کاربر`\n\n"
+            "*مثال:*\n"
+            "`/endchat 123456789`",
+            parse_mode="Markdown"
+        )
+        return
+    
+    target_user_id = context.args[0].strip()
+    
+    pending_messages = context.bot_data.get("pending_messages", {})
+    active_conversation = None
+    message_id = None
+    
+    for mid, data in pending_messages.items():
+        if (data["user_id"] == target_user_id and 
+            data.get("delegated_to") == user_id and
             not data.get("completed") and 
             data.get("conversation_active")):
             active_conversation = data
@@ -648,13 +1668,18 @@ async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     
-    active_conversation["completed"] = True
-    active_conversation["completed_by"] = user_id
-    active_conversation["completion_time"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-    active_conversation["conversation_active"] = False
-    active_conversation["end_reason"] = "admin_ended"
+    update_ticket(
+        context.bot_data, active_conversation,
+        completed=True,
+        completed_by=user_id,
+        completion_time=datetime.now().strftime("%Y-%m-%d %H:%M"),
+        conversation_active=False,
+        end_reason="admin_ended"
+    )
+    record_ticket_event(context.bot_data, "completed", message_id, active_conversation, user_id)
+    settle_relay_burst(context, message_id)
     
-    admin_name = get_admin_name(user_id)
+    admin_name = config.admin_name(user_id)
     target_user_id = active_conversation["user_id"]
     
     try:
@@ -671,13 +1696,13 @@ async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     completion_message = (
         f"🔚 *مکالمه به پایان رسید*\n\n"
         f"👤 پایان‌دهنده: {admin_name}\n"
-        f"📛 یوزرنیم کاربر: {active_conversation['username']}\n"
+        f"📛 یوزرنیم کاربر: {escape_markdown(active_conversation['username'])}\n"
         f"🆔 شناسه کاربر: `{active_conversation['user_id']}`\n"
         f"📂 بخش: {active_conversation['section']}\n"
         f"⏰ زمان پایان: {active_conversation['completion_time']}\n"
     )
     
-    for admin_id in PRIMARY_ADMINS:
+    for admin_id in config.primary_admins:
         try:
             await context.bot.send_message(admin_id, completion_message, parse_mode="Markdown")
         except TelegramError as e:
@@ -687,9 +1712,10 @@ async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def full_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show detailed status for admins"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id not in PRIMARY_ADMINS and user_id not in SECONDARY_ADMINS:
+    if user_id not in config.primary_admins and user_id not in config.secondary_admins:
         await update.message.reply_text("❌ شما مجاز به مشاهده این اطلاعات نیستید.")
         return
     
@@ -718,7 +1744,7 @@ async def full_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for data in pending_messages.values():
         if data.get("delegated_to"):
             admin_id = data["delegated_to"]
-            admin_name = get_admin_name(admin_id)
+            admin_name = config.admin_name(admin_id)
             if admin_name not in admin_stats:
                 admin_stats[admin_name] = {
                     "total": 0, 
@@ -738,7 +1764,7 @@ async def full_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status_msg += "👥 *آمار ادمین‌ها:*\n"
         for admin_name, stats in admin_stats.items():
             admin_id = None
-            for aid, name in ADMIN_NAMES.items():
+            for aid, name in config.admin_names.items():
                 if name == admin_name:
                     admin_id = aid
                     break
@@ -755,14 +1781,530 @@ async def full_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"   ⏳ معلق: {pending_admin}\n\n"
         )
     
+    latency = context.bot_data.get("latency", {})
+    overall = latency_report(merged_latency(latency, "s:"))
+    if overall:
+        status_msg += "⏱ *زمان پاسخ‌گویی (p50 | p90 | p99):*\n" + overall + "\n"
+        for dimension, sketches in latency.items():
+            report = latency_report(sketches, indent="   ")
+            if not report:
+                continue
+            if dimension.startswith("s:"):
+                status_msg += f"📂 {dimension[2:]}:\n{report}"
+            else:
+                status_msg += f"👤 {config.admin_name(dimension[2:])}:\n{report}"
+    
     await update.message.reply_text(status_msg, parse_mode="Markdown")
 
 
+def record_ticket_event(bot_data: Dict, event: str, ticket_id: str, ticket: Dict,
+                        admin_id: Optional[str] = None) -> None:
+    """Count a ticket lifecycle event in the hourly and daily rollups
+
+    Each bucket maps a dimension ("s:<section>" or "a:<admin_id>") to a
+    counter list ordered like ROLLUP_EVENTS, so /stats never scans tickets.
+    The event is timestamped on the ticket and feeds the response-time
+    sketches. It also updates the TicketIndex and goes out on the dashboard feed.
+    """
+    now = datetime.now()
+    rollups = bot_data.setdefault("rollups", {"hourly": {}, "daily": {}})
+    index = ROLLUP_EVENTS.index(event)
+
+    dimensions = [f"s:{ticket.get('section', 'نامشخص')}"]
+    if admin_id:
+        dimensions.append(f"a:{admin_id}")
+
+    for granularity, key in (("hourly", now.strftime("%Y-%m-%d %H")), ("daily", now.strftime("%Y-%m-%d"))):
+        bucket = rollups[granularity].setdefault(key, {})
+        for dimension in dimensions:
+            counters = bucket.setdefault(dimension, [0] * len(ROLLUP_EVENTS))
+            counters[index] += 1
+
+    bot_data["rollups_dirty"] = True
+    bot_data["tickets_dirty"] = True
+
+    ticket.setdefault(EVENT_TIMESTAMPS[event], time.time())
+    record_latency(bot_data, event, ticket)
+
+    if "ticket_index" in bot_data:
+        bot_data["ticket_index"].update(event, ticket_id, ticket)
+    dashboard = bot_data.get("dashboard")
+    if dashboard is not None:
+        dashboard.publish(bot_data["config"].name, {
+            "event": event,
+            "ticket": ticket_id,
+            "section": ticket.get("section"),
+            "admin": admin_id,
+            "time": now.isoformat(timespec="seconds"),
+        })
+
+class LatencySketch:
+    """Mergeable quantile sketch of durations in seconds, in bounded memory
+
+    Durations fall into logarithmic bins (bin i covers gamma**(i-1) to
+    gamma**i), so any reported quantile is within SKETCH_ACCURACY of a real
+    sample. Sketches add up bin by bin, which gives totals over sections or
+    admins without keeping samples.
+    """
+
+    def __init__(self, bins: Optional[Dict] = None):
+        self.gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        self.bins: Dict[int, int] = {int(i): count for i, count in (bins or {}).items()}
+        self.count = sum(self.bins.values())
+
+    def add(self, seconds: float) -> None:
+        # Anything under a second is reported as one second
+        index = max(0, math.ceil(math.log(max(seconds, 1.0), self.gamma)))
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        if len(self.bins) > SKETCH_MAX_BINS:
+            lowest, second = sorted(self.bins)[:2]
+            self.bins[second] += self.bins.pop(lowest)
+
+    def merge(self, other: "LatencySketch") -> None:
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return None
+
+def record_latency(bot_data: Dict, event: str, ticket: Dict) -> None:
+    """Add the durations an event ends to the section's and the responsible admin's sketches
+
+    delegate runs from creation to delegation and belongs to whoever
+    delegated; first_reply runs from delegation to the first answer and
+    close from creation to completion, both belonging to the assigned admin.
+    Tickets from before precise timestamps are skipped.
+    """
+    if event == "delegated":
+        metric, start, admin_id = "delegate", ticket.get("created_at"), ticket.get("delegated_by")
+    elif event == "answered":
+        metric, start, admin_id = "first_reply", ticket.get("delegated_at"), ticket.get("delegated_to")
+    elif event == "completed":
+        metric, start, admin_id = "close", ticket.get("created_at"), ticket.get("delegated_to")
+    else:
+        return
+    if start is None:
+        return
+
+    seconds = ticket[EVENT_TIMESTAMPS[event]] - start
+    latency = bot_data.setdefault("latency", {})
+    dimensions = [f"s:{ticket.get('section', 'نامشخص')}"]
+    if admin_id:
+        dimensions.append(f"a:{admin_id}")
+    for dimension in dimensions:
+        latency.setdefault(dimension, {}).setdefault(metric, LatencySketch()).add(seconds)
+    bot_data["latency_dirty"] = True
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f} ثانیه"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} دقیقه"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f} ساعت"
+    return f"{seconds / 86400:.1f} روز"
+
+def latency_report(sketches: Dict[str, LatencySketch], indent: str = "") -> str:
+    """p50/p90/p99 lines for each metric that has samples"""
+    lines = []
+    for metric, label in LATENCY_METRICS:
+        sketch = sketches.get(metric)
+        if sketch is None or not sketch.count:
+            continue
+        quantiles = " | ".join(
+            f"p{int(q * 100)} {format_duration(sketch.quantile(q))}" for q in (0.5, 0.9, 0.99)
+        )
+        lines.append(f"{indent}⏱ {label}: {quantiles} ({sketch.count})\n")
+    return "".join(lines)
+
+def merged_latency(latency: Dict, prefix: str) -> Dict[str, LatencySketch]:
+    """Add up the sketches of every dimension with the given prefix"""
+    totals = {}
+    for dimension, sketches in latency.items():
+        if dimension.startswith(prefix):
+            for metric, sketch in sketches.items():
+                totals.setdefault(metric, LatencySketch()).merge(sketch)
+    return totals
+
+class TicketIndex:
+    """Open tickets by status and each admin's open tickets, kept current by record_ticket_event
+
+    Lets the dashboard answer without scanning every ticket ever received.
+    """
+
+    def __init__(self, tickets: Dict):
+        self.new = set()
+        self.delegated = set()
+        self.completed = 0
+        self.load: Dict[str, set] = {}
+        for ticket_id, ticket in tickets.items():
+            if ticket.get("completed"):
+                self.completed += 1
+            elif ticket.get("delegated_to"):
+                self.update("delegated", ticket_id, ticket)
+            else:
+                self.new.add(ticket_id)
+
+    def update(self, event: str, ticket_id: str, ticket: Dict) -> None:
+        if event == "created":
+            self.new.add(ticket_id)
+        elif event == "delegated":
+            self.new.discard(ticket_id)
+            self.delegated.add(ticket_id)
+            self.load.setdefault(ticket["delegated_to"], set()).add(ticket_id)
+        elif event == "completed":
+            self.new.discard(ticket_id)
+            self.delegated.discard(ticket_id)
+            self.load.get(ticket.get("delegated_to"), set()).discard(ticket_id)
+            self.completed += 1
+
+def dashboard_snapshot(application) -> Dict:
+    """Queues and admin load of one bot, from its TicketIndex"""
+    config = application.bot_data["config"]
+    tickets = application.bot_data["pending_messages"]
+    index = application.bot_data["ticket_index"]
+    now = time.time()
+
+    waiting = sorted(index.new, key=lambda ticket_id: ticket_created_at(tickets[ticket_id]))
+    return {
+        "counts": {"new": len(index.new), "delegated": len(index.delegated), "completed": index.completed},
+        "queue": [
+            {
+                "id": ticket_id,
+                "user_id": tickets[ticket_id]["user_id"],
+                "username": tickets[ticket_id]["username"],
+                "section": tickets[ticket_id]["section"],
+                "waiting": int(now - ticket_created_at(tickets[ticket_id])),
+            }
+            for ticket_id in waiting[:DASHBOARD_QUEUE_LIMIT]
+        ],
+        "active": [
+            {
+                "id": ticket_id,
+                "user_id": tickets[ticket_id]["user_id"],
+                "section": tickets[ticket_id]["section"],
+                "admin": config.admin_name(tickets[ticket_id]["delegated_to"]),
+                "answered": bool(tickets[ticket_id].get("admin_reply")),
+                "since": tickets[ticket_id].get("delegation_time"),
+            }
+            for ticket_id in sorted(index.delegated)
+        ],
+        "load": {
+            admin_id: {"name": config.admin_name(admin_id), "open": len(index.load.get(admin_id, ()))}
+            for admin_id in config.secondary_admins
+        },
+    }
+
+DASHBOARD_PAGE = """<!doctype html>
+<html dir="rtl" lang="fa"><head><meta charset="utf-8"><title>داشبورد پشتیبانی</title>
+<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;margin-bottom:1.5em}
+td,th{border:1px solid #ccc;padding:.3em .6em}#events{font-family:monospace;white-space:pre}</style></head>
+<body><div id="bots"></div><h3>رویدادها</h3><div id="events"></div>
+<script>
+function table(rows, columns) {
+  const t = document.createElement("table");
+  const head = t.insertRow();
+  columns.forEach(c => { const th = document.createElement("th"); th.textContent = c; head.appendChild(th); });
+  rows.forEach(r => { const tr = t.insertRow(); columns.forEach(c => { tr.insertCell().textContent = r[c]; }); });
+  return t;
+}
+async function refresh() {
+  const bots = await (await fetch("/api/tickets")).json();
+  const root = document.getElementById("bots");
+  root.replaceChildren();
+  for (const [name, s] of Object.entries(bots)) {
+    const h = document.createElement("h2");
+    h.textContent = `${name}: ${s.counts.new} جدید، ${s.counts.delegated} در جریان، ${s.counts.completed} تکمیل شده`;
+    root.append(h, table(s.queue, ["waiting", "section", "username", "user_id", "id"]),
+      table(s.active, ["admin", "answered", "since", "section", "user_id", "id"]),
+      table(Object.entries(s.load).map(([id, l]) => ({id, ...l})), ["name", "open", "id"]));
+  }
+}
+refresh();
+let pending = null;
+new EventSource("/events").onmessage = e => {
+  const log = document.getElementById("events");
+  log.textContent = e.data + "\\n" + log.textContent.split("\\n").slice(0, 50).join("\\n");
+  // A burst of events costs one /api/tickets request
+  if (pending === null) pending = setTimeout(() => { pending = null; refresh(); }, 1000);
+};
+</script></body></html>
+"""
+
+class Dashboard:
+    """Read-only local HTTP dashboard for every bot in the process
+
+    GET /                the page
+    GET /api/tickets     queues and admin load per bot
+    GET /api/metrics     the latest metrics export per bot (every STATE_FLUSH_INTERVAL)
+    GET /events          server-sent events, one per ticket lifecycle event
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.apps: Dict[str, object] = {}
+        self.subscribers = set()
+        self.connections = set()
+
+    def publish(self, bot: str, event: Dict) -> None:
+        data = json.dumps({"bot": bot, **event}, ensure_ascii=False)
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # A client that stopped reading loses its feed instead of buffering forever
+                self.subscribers.discard(queue)
+
+    async def serve(self) -> None:
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Dashboard on http://{self.host}:{self.port}/")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in list(self.connections):
+                task.cancel()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass  # headers are not needed
+            if len(request_line) < 2 or request_line[0] != "GET":
+                await self.respond(writer, 405, "text/plain", b"Method Not Allowed")
+                return
+
+            path = request_line[1].split("?", 1)[0]
+            if path == "/":
+                await self.respond(writer, 200, "text/html; charset=utf-8", DASHBOARD_PAGE.encode())
+            elif path == "/api/tickets":
+                payload = {name: dashboard_snapshot(app) for name, app in self.apps.items()}
+                await self.respond(writer, 200, "application/json", json.dumps(payload, ensure_ascii=False).encode())
+            elif path == "/api/metrics":
+                # The export state_flush_loop computes anyway; collect_metrics scans every ticket and user
+                payload = {name: app.bot_data.get("metrics_export") for name, app in self.apps.items()}
+                await self.respond(writer, 200, "application/json", json.dumps(payload).encode())
+            elif path == "/events":
+                await self.stream(writer)
+            else:
+                await self.respond(writer, 404, "text/plain", b"Not Found")
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes) -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def stream(self, writer: asyncio.StreamWriter) -> None:
+        queue = asyncio.Queue(maxsize=DASHBOARD_EVENT_BUFFER)
+        self.subscribers.add(queue)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+            )
+            await writer.drain()
+            while queue in self.subscribers:
+                try:
+                    data = await asyncio.wait_for(queue.get(), DASHBOARD_HEARTBEAT)
+                    writer.write(f"data: {data}\n\n".encode())
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+                await writer.drain()
+        finally:
+            self.subscribers.discard(queue)
+
+def prune_rollups(rollups: Dict) -> None:
+    """Drop hourly buckets older than ROLLUP_HOURLY_RETENTION_DAYS"""
+    cutoff = (datetime.now() - timedelta(days=ROLLUP_HOURLY_RETENTION_DAYS)).strftime("%Y-%m-%d %H")
+    for key in [k for k in rollups["hourly"] if k < cutoff]:
+        del rollups["hourly"][key]
+
+def sum_rollups(buckets: Dict, keys: List[str]) -> Dict[str, List[int]]:
+    """Add up the counters of the given bucket keys per dimension"""
+    totals = {}
+    for key in keys:
+        for dimension, counters in buckets.get(key, {}).items():
+            total = totals.setdefault(dimension, [0] * len(ROLLUP_EVENTS))
+            for i, value in enumerate(counters):
+                total[i] += value
+    return totals
+
+async def flush_rollups(application) -> None:
+    """Persist rollups if they changed since the last flush"""
+    bot_data = application.bot_data
+    if not bot_data.get("rollups_dirty") or "rollups" not in bot_data:
+        return
+    prune_rollups(bot_data["rollups"])
+    bot_data["rollups_dirty"] = False
+    payload = json.dumps(bot_data["rollups"], ensure_ascii=False)
+    await asyncio.to_thread(write_state, state_file(application, ROLLUP_STATE), payload)
+
+async def flush_latency(application) -> None:
+    """Persist the response-time sketches if they changed since the last flush"""
+    bot_data = application.bot_data
+    if not bot_data.get("latency_dirty"):
+        return
+    bot_data["latency_dirty"] = False
+    payload = json.dumps({
+        dimension: {metric: sketch.bins for metric, sketch in sketches.items()}
+        for dimension, sketches in bot_data["latency"].items()
+    }, ensure_ascii=False)
+    await asyncio.to_thread(write_state, state_file(application, LATENCY_STATE), payload)
+
+class RouteIndex:
+    """Bounded LRU map from a message the bot sent to an admin to the ticket it belongs to
+
+    Lets a secondary admin use Telegram's reply feature on any relayed message
+    to answer that ticket's user, whatever other conversations are open.
+    """
+
+    def __init__(self, routes: Optional[List] = None):
+        self.routes: "OrderedDict[str, str]" = OrderedDict(routes or [])
+        self.dirty = False
+
+    def add(self, chat_id, message_id: int, ticket_id: str) -> None:
+        key = f"{chat_id}:{message_id}"
+        self.routes[key] = ticket_id
+        self.routes.move_to_end(key)
+        while len(self.routes) > ROUTE_INDEX_SIZE:
+            self.routes.popitem(last=False)
+        self.dirty = True
+
+    def get(self, chat_id, message_id: int) -> Optional[str]:
+        key = f"{chat_id}:{message_id}"
+        ticket_id = self.routes.get(key)
+        if ticket_id is not None:
+            self.routes.move_to_end(key)
+        return ticket_id
+
+async def flush_routes(application) -> None:
+    """Persist the reply routing index if it changed"""
+    routes = application.bot_data["routes"]
+    if not routes.dirty:
+        return
+    routes.dirty = False
+    payload = json.dumps(list(routes.routes.items()))
+    await asyncio.to_thread(write_state, state_file(application, ROUTES_STATE), payload)
+
+async def snapshot_tickets(application, force: bool = False) -> None:
+    """Persist pending_messages so tickets survive restarts"""
+    bot_data = application.bot_data
+    if not force and not bot_data.get("tickets_dirty"):
+        return
+    bot_data["tickets_dirty"] = False
+    payload = json.dumps(bot_data.get("pending_messages", {}), ensure_ascii=False)
+    await asyncio.to_thread(write_state, state_file(application, TICKETS_STATE), payload)
+
+async def state_flush_loop(application) -> None:
+    """Periodically persist rollups, latency sketches, tickets and the routing index, and export metrics"""
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        try:
+            await flush_rollups(application)
+            await flush_latency(application)
+            await snapshot_tickets(application)
+            await flush_routes(application)
+            application.bot_data["metrics_export"] = collect_metrics(application)
+            payload = json.dumps(application.bot_data["metrics_export"])
+            await asyncio.to_thread(write_state, state_file(application, METRICS_STATE), payload)
+        except OSError as e:
+            logger.error(f"Error saving state: {e}")
+
+def parse_stats_range(args: List[str]):
+    """Parse `/stats <N>h` or `/stats from_date [to_date]` into (granularity, bucket keys, title)"""
+    if len(args) == 1 and args[0].lower().endswith("h") and args[0][:-1].isdigit():
+        hours = min(int(args[0][:-1]), ROLLUP_HOURLY_RETENTION_DAYS * 24)
+        now = datetime.now()
+        keys = [(now - timedelta(hours=h)).strftime("%Y-%m-%d %H") for h in range(hours)]
+        return "hourly", keys, f"{hours} ساعت اخیر"
+
+    if len(args) not in (1, 2):
+        return None
+    try:
+        start = datetime.strptime(args[0], "%Y-%m-%d")
+        end = datetime.strptime(args[-1], "%Y-%m-%d")
+    except ValueError:
+        return None
+    if end < start:
+        return None
+    days = (end - start).days + 1
+    keys = [(start + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(days)]
+    return "daily", keys, f"{args[0]} تا {args[-1]}"
+
+async def stats_for_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show rollup statistics for a time range"""
+    config = get_config(context)
+    parsed = parse_stats_range(context.args)
+    if parsed is None:
+        await update.message.reply_text(
+            "📝 *نحوه استفاده:*\n"
+            "`/stats` - آمار کل\n"
+            "`/stats 24h` - آمار ساعت‌های اخیر\n"
+            "`/stats 2024-01-01 2024-01-31` - آمار بازه تاریخ",
+            parse_mode="Markdown"
+        )
+        return
+
+    granularity, keys, title = parsed
+    rollups = context.bot_data.get("rollups", {"hourly": {}, "daily": {}})
+    totals = sum_rollups(rollups[granularity], keys)
+
+    sections = {d[2:]: c for d, c in totals.items() if d.startswith("s:")}
+    admins = {d[2:]: c for d, c in totals.items() if d.startswith("a:")}
+    overall = [sum(c[i] for c in sections.values()) for i in range(len(ROLLUP_EVENTS))]
+
+    msg = (
+        f"📊 *آمار ربات ({title})*\n\n"
+        f"📩 ایجاد شده: {overall[0]}\n"
+        f"👥 ارجاع شده: {overall[1]}\n"
+        f"💬 پاسخ داده شده: {overall[2]}\n"
+        f"✅ تکمیل شده: {overall[3]}\n\n"
+    )
+
+    if sections:
+        msg += "*📂 آمار بخش‌ها:*\n"
+        for section, c in sections.items():
+            msg += f"• {section}: 📩 {c[0]} | 👥 {c[1]} | 💬 {c[2]} | ✅ {c[3]}\n"
+        msg += "\n"
+
+    if admins:
+        msg += "*👤 آمار ادمین‌ها:*\n"
+        for admin_id, c in admins.items():
+            msg += f"• {config.admin_name(admin_id)}: 👥 {c[1]} | 💬 {c[2]} | ✅ {c[3]}\n"
+
+    await update.message.reply_text(msg, parse_mode="Markdown")
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show bot statistics (Primary admins only)"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
-    if user_id not in PRIMARY_ADMINS:
+    if user_id not in config.primary_admins:
         return
+
+    if context.args:
+        return await stats_for_range(update, context)
     
     pending_messages = context.bot_data.get("pending_messages", {})
     total_messages = len(pending_messages)
@@ -773,7 +2315,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for data in pending_messages.values():
         if data.get("delegated_to"):
             admin_id = data["delegated_to"]
-            admin_name = get_admin_name(admin_id)
+            admin_name = config.admin_name(admin_id)
             if admin_name not in admin_stats:
                 admin_stats[admin_name] = {"total": 0, "completed": 0}
             admin_stats[admin_name]["total"] += 1
@@ -786,6 +2328,15 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ تکمیل شده: {completed_messages}\n"
         f"⏳ در انتظار: {pending_count}\n\n"
     )
+
+    flood = context.bot_data["flood"]
+    if flood.dropped or flood.muted:
+        msg += (
+            f"*🚧 کنترل ارسال پیاپی:*\n"
+            f"🗑️ پیام‌های رد شده: {flood.dropped}\n"
+            f"🔇 دفعات محدودسازی: {flood.mutes}\n"
+            f"⏳ کاربران محدود فعلی: {len(flood.muted)}\n\n"
+        )
     
     if admin_stats:
         msg += "*📊 آمار ادمین‌ها:*\n"
@@ -795,34 +2346,164 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(msg, parse_mode="Markdown")
 
+EXPORT_FIELDS = [
+    "message_id", "user_id", "username", "section", "date", "message_count",
+    "delegated_to", "delegated_by", "delegation_time", "first_reply_time",
+    "answered", "completed", "completed_by", "completion_time", "end_reason",
+]
+
+def parse_export_args(args: List[str]) -> Optional[Dict]:
+    """Parse `/export [csv|jsonl] [from_date] [to_date] [section]`, None on bad input"""
+    options = {"format": "csv", "from": None, "to": None, "section": None}
+    dates = []
+    for arg in args:
+        if arg.lower() in ("csv", "jsonl"):
+            options["format"] = arg.lower()
+            continue
+        try:
+            datetime.strptime(arg, "%Y-%m-%d")
+            dates.append(arg)
+            continue
+        except ValueError:
+            pass
+        options["section"] = arg
+    if len(dates) > 2 or (len(dates) == 2 and dates[0] > dates[1]):
+        return None
+    if dates:
+        options["from"] = dates[0]
+        options["to"] = dates[-1] if len(dates) == 2 else None
+    return options
+
+def export_record(message_id: str, data: Dict) -> Dict:
+    """Flatten a ticket into an export row"""
+    return {
+        "message_id": message_id,
+        "user_id": data.get("user_id"),
+        "username": data.get("username"),
+        "section": data.get("section"),
+        "date": data.get("date"),
+        "message_count": len(data.get("messages", [])),
+        "delegated_to": data.get("delegated_to", ""),
+        "delegated_by": data.get("delegated_by", ""),
+        "delegation_time": data.get("delegation_time", ""),
+        "first_reply_time": data.get("first_reply_time", ""),
+        "answered": bool(data.get("admin_reply")),
+        "completed": bool(data.get("completed")),
+        "completed_by": data.get("completed_by", ""),
+        "completion_time": data.get("completion_time", ""),
+        "end_reason": data.get("end_reason", ""),
+    }
+
+def export_matches(data: Dict, options: Dict) -> bool:
+    """Check a ticket against the export date range and section filters"""
+    day = data.get("date", "")[:10]
+    if options["from"] and day < options["from"]:
+        return False
+    if options["to"] and day > options["to"]:
+        return False
+    if options["section"] and options["section"] not in data.get("section", ""):
+        return False
+    return True
+
+def write_export(path: str, tickets: List, options: Dict) -> int:
+    """Stream tickets into a gzip-compressed CSV/JSONL file; runs in a worker thread"""
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        if options["format"] == "csv":
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for message_id, data in tickets:
+            if not export_matches(data, options):
+                continue
+            record = export_record(message_id, data)
+            if options["format"] == "csv":
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+async def export_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Export ticket history as a compressed CSV/JSONL document (Primary admins only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+    if user_id not in config.primary_admins:
+        return
+
+    options = parse_export_args(context.args or [])
+    if options is None:
+        await update.message.reply_text(
+            "📝 *نحوه استفاده:*\n"
+            "`/export [csv|jsonl] [از_تاریخ] [تا_تاریخ] [بخش]`\n\n"
+            "*مثال:*\n"
+            "`/export csv 2024-01-01 2024-01-31 فارکس`",
+            parse_mode="Markdown"
+        )
+        return
+
+    # Only the (id, ticket) references are copied here; rows are built in the worker thread
+    tickets = list(context.bot_data.get("pending_messages", {}).items())
+
+    fd, path = tempfile.mkstemp(suffix=f".{options['format']}.gz")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(write_export, path, tickets, options)
+        if not count:
+            await update.message.reply_text("📭 هیچ تیکتی با این فیلترها یافت نشد.")
+            return
+
+        filename = f"tickets_{datetime.now().strftime('%Y%m%d_%H%M')}.{options['format']}.gz"
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                update.message.chat_id,
+                f,
+                filename=filename,
+                caption=f"📦 خروجی {count} تیکت"
+            )
+    except (OSError, TelegramError) as e:
+        logger.error(f"Error exporting tickets: {e}")
+        await update.message.reply_text("❌ خطا در تهیه خروجی.")
+    finally:
+        os.remove(path)
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show help for admins"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id == SUPER_ADMIN:
+    if user_id == config.super_admin:
         help_msg = (
             "🚀 *راهنمای مدیر کل سیستم*\n\n"
             "🔧 *دستورات اختصاصی:*\n"
             "`/help` - نمایش این راهنما\n"
             "`/broadcast متن` - ارسال پیام به همه ادمین‌ها\n"
+            "`/announce متن` - ارسال اطلاعیه به همه کاربران\n"
+            "`/metrics` - متریک‌های فنی ربات\n"
+            "`/profile ثانیه` - پروفایل‌گیری از ربات در حال اجرا\n"
+            "`/memstats [trace]` - مصرف حافظه به تفکیک ساختار\n"
             "`/admins` - لیست تمام ادمین‌ها\n"
             "`/fullstatus` - گزارش کامل سیستم\n"
             "`/adminstatus شناسه` - وضعیت ادمین مشخص\n"
             "`/pending` - لیست پیام‌های در انتظار\n"
-            "`/stats` - آمار کلی ربات\n\n"
+            "`/stats` - آمار کلی ربات\n"
+            "`/export` - خروجی تاریخچه تیکت‌ها\n\n"
             "💡 *مثال‌ها:*\n"
             "`/broadcast اطلاعیه مهم برای همه`\n"
             "`/adminstatus 393746429`"
         )
         
-    elif user_id in PRIMARY_ADMINS:
+    elif user_id in config.primary_admins:
         help_msg = (
             "👑 *راهنمای ادمین اصلی*\n\n"
             "🔧 *دستورات موجود:*\n"
             "`/help` - نمایش این راهنما\n"
             "`/fullstatus` - گزارش کامل سیستم\n"
             "`/pending` - لیست پیام‌های در انتظار\n"
-            "`/stats` - آمار کلی ربات\n"
+            "`/stats [بازه]` - آمار کلی ربات (مثال: `/stats 24h` یا `/stats 2024-01-01 2024-01-31`)\n"
+            "`/export [csv|jsonl] [از_تاریخ] [تا_تاریخ] [بخش]` - خروجی تاریخچه تیکت‌ها\n"
+            "`/deadletters` - پیام‌هایی که ارسالشان ناموفق بود\n"
+            "`/history شناسه_کاربر [صفحه]` - تاریخچه مکالمه با کاربر\n"
+            "`/unmute شناسه_کاربر` - رفع محدودیت کاربر پرارسال\n"
             "`/adminstatus شناسه` - وضعیت ادمین مشخص\n\n"
             "⚡ *قابلیت‌ها:*\n"
             "• دریافت تمامی پیام‌های کاربران\n"
@@ -838,16 +2519,18 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "`/adminstatus 393746429` - وضعیت محمد"
         )
         
-    elif user_id in SECONDARY_ADMINS:
-        admin_name = get_admin_name(user_id)
+    elif user_id in config.secondary_admins:
+        admin_name = config.admin_name(user_id)
         help_msg = (
             f"🔧 *راهنمای {admin_name}*\n\n"
             "🔧 *دستورات موجود:*\n"
             "`/help` - نمایش این راهنما\n"
             "`/mytask` - تسک‌های اختصاص داده شده\n"
+            "`/next [بخش]` - برداشتن قدیمی‌ترین تیکت بی‌صاحب از صف\n"
             "`/mystatus` - وضعیت و آمار شخصی من\n"
             "`/fullstatus` - گزارش کامل سیستم\n"
-            "`/endchat شناسه_کاربر` - پایان مکالمه با کاربر مشخص\n\n"
+            "`/endchat شناسه_کاربر` - پایان مکالمه با کاربر مشخص\n"
+            "`/history شناسه_کاربر` - تاریخچه مکالمه با کاربر\n\n"
             "⚡ *قابلیت‌ها:*\n"
             "• دریافت پیام‌های ارجاعی\n"
             "• پاسخ‌گویی به کاربران\n"
@@ -877,9 +2560,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show specific admin status by ID (Primary admins only)"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id not in PRIMARY_ADMINS:
+    if user_id not in config.primary_admins:
         await update.message.reply_text("❌ شما مجاز به استفاده از این دستور نیستید.")
         return
     
@@ -888,14 +2572,14 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
             "📝 *نحوه استفاده:*\n"
             "`/adminstatus شناسه_ادمین`\n\n"
             "*ادمین‌های موجود:*\n" + 
-            "\n".join([f"• `{aid}` - {name}" for aid, name in ADMIN_NAMES.items()]),
+            "\n".join([f"• `{aid}` - {name}" for aid, name in config.admin_names.items()]),
             parse_mode="Markdown"
         )
         return
     
     target_admin_id = context.args[0].strip()
     
-    if target_admin_id not in SECONDARY_ADMINS:
+    if target_admin_id not in config.secondary_admins:
         await update.message.reply_text(f"❌ ادمین با شناسه `{target_admin_id}` یافت نشد.")
         return
     
@@ -904,7 +2588,7 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
                      if data.get("delegated_to") == target_admin_id]
     
     if not admin_messages:
-        admin_name = get_admin_name(target_admin_id)
+        admin_name = config.admin_name(target_admin_id)
         await update.message.reply_text(f"📭 {admin_name} هیچ تسکی ندارد.")
         return
     
@@ -914,7 +2598,7 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
     answered = len([m for m in admin_messages if m.get("admin_reply")])
     pending = total - completed
     
-    admin_name = get_admin_name(target_admin_id)
+    admin_name = config.admin_name(target_admin_id)
     
     status_msg = (
         f"👤 *وضعیت {admin_name}* (`{target_admin_id}`)\n\n"
@@ -925,6 +2609,10 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
         f"⏳ در انتظار: {pending}\n\n"
     )
     
+    report = latency_report(context.bot_data.get("latency", {}).get(f"a:{target_admin_id}", {}))
+    if report:
+        status_msg += "⏱ *زمان پاسخ‌گویی (p50 | p90 | p99):*\n" + report + "\n"
+    
     active_tasks = [m for m in admin_messages if not m.get("completed")]
     if active_tasks:
         status_msg += "📋 *تسک‌های فعال:*\n"
@@ -941,9 +2629,10 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def broadcast_to_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send message to all admins (Super admin only)"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id != SUPER_ADMIN:
+    if user_id != config.super_admin:
         return  
     
     if not context.args:
@@ -959,7 +2648,7 @@ async def broadcast_to_admins(update: Update, context: ContextTypes.DEFAULT_TYPE
     message_text = " ".join(context.args)
     sender_name = "مدیر کل سیستم"
     
-    all_admins = set(PRIMARY_ADMINS + SECONDARY_ADMINS)
+    all_admins = set(config.primary_admins + config.secondary_admins)
     
     sent_count = 0
     failed_count = 0
@@ -987,28 +2676,199 @@ async def broadcast_to_admins(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     await update.message.reply_text(result_msg, parse_mode="Markdown")
 
+def collect_announcement_recipients(bot_data: Dict) -> List[str]:
+    """Every user who has opened a ticket, minus users who blocked the bot"""
+    blocked = bot_data.get("blocked_users", set())
+    recipients = []
+    seen = set()
+    for data in bot_data.get("pending_messages", {}).values():
+        target_user_id = data["user_id"]
+        if target_user_id in seen or target_user_id in blocked:
+            continue
+        seen.add(target_user_id)
+        recipients.append(target_user_id)
+    return recipients
+
+def format_announcement_progress(job: Dict) -> str:
+    """Progress report shown to the super admin while an announcement is running"""
+    total = len(job["recipients"])
+    if job.get("done"):
+        title = "✅ *ارسال اطلاعیه به پایان رسید*"
+    elif job.get("cancelled"):
+        title = "⛔️ *ارسال اطلاعیه متوقف شد*"
+    else:
+        title = "⏳ *در حال ارسال اطلاعیه...*"
+    return (
+        f"{title}\n\n"
+        f"📊 پیشرفت: {job['cursor']}/{total}\n"
+        f"✅ ارسال موفق: {job['sent']}\n"
+        f"❌ ارسال ناموفق: {job['failed']}\n"
+        f"🚫 مسدود کرده‌اند: {job['blocked']}"
+    )
+
+async def save_announcement_checkpoint(application, job: Dict) -> None:
+    """Persist job progress and the blocked-user list without blocking the event loop"""
+    blocked = sorted(application.bot_data.get("blocked_users", set()))
+    await asyncio.to_thread(save_state, state_file(application, ANNOUNCEMENT_STATE), job)
+    await asyncio.to_thread(save_state, state_file(application, BLOCKED_USERS_STATE), blocked)
+
+async def report_announcement_progress(application, job: Dict) -> None:
+    """Edit the super admin's progress message in place"""
+    try:
+        await application.bot.edit_message_text(
+            format_announcement_progress(job),
+            chat_id=job["status_chat_id"],
+            message_id=job["status_message_id"],
+            parse_mode="Markdown"
+        )
+    except TelegramError as e:
+        logger.warning(f"Error updating announcement progress: {e}")
+
+async def run_announcement(application, job: Dict) -> None:
+    """Send an announcement to job["recipients"], resuming from job["cursor"]
+
+    Sends are paced to BROADCAST_RATE and progress is checkpointed every
+    BROADCAST_CHECKPOINT_EVERY recipients, so after a crash at most that many
+    users can receive the announcement twice.
+    """
+    bot = application.bot
+    blocked = application.bot_data.setdefault("blocked_users", set())
+    recipients = job["recipients"]
+    interval = 1 / BROADCAST_RATE
+
+    try:
+        while job["cursor"] < len(recipients):
+            target_user_id = recipients[job["cursor"]]
+            started = time.monotonic()
+
+            if target_user_id not in blocked:
+                try:
+                    await bot.send_message(target_user_id, job["text"], parse_mode="Markdown")
+                    job["sent"] += 1
+                except RetryAfter as e:
+                    delay = retry_after_seconds(e)
+                    logger.warning(f"Announcement hit flood control, sleeping {delay}s")
+                    await asyncio.sleep(delay)
+                    continue
+                except Forbidden:
+                    blocked.add(target_user_id)
+                    job["blocked"] += 1
+                except TelegramError as e:
+                    logger.error(f"Error sending announcement to user {target_user_id}: {e}")
+                    job["failed"] += 1
+
+            job["cursor"] += 1
+
+            if job["cursor"] % BROADCAST_CHECKPOINT_EVERY == 0:
+                await save_announcement_checkpoint(application, job)
+            if job["cursor"] % BROADCAST_PROGRESS_EVERY == 0:
+                await report_announcement_progress(application, job)
+
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+        job["done"] = True
+        logger.info(f"Announcement {job['id']} finished: {job['sent']} sent, "
+                    f"{job['failed']} failed, {job['blocked']} blocked")
+    finally:
+        # Also runs on cancellation (shutdown or /announce cancel), so a restart resumes here
+        await asyncio.shield(save_announcement_checkpoint(application, job))
+
+    await report_announcement_progress(application, job)
+
+def start_announcement(application, job: Dict) -> None:
+    """Start (or resume) an announcement job in the background"""
+    application.bot_data["announcement_job"] = job
+    application.bot_data["announcement_task"] = start_background_task(
+        application, run_announcement(application, job), name=f"announcement_{job['id']}"
+    )
+
+async def announce_to_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Announce a message to every user who has opened a ticket (Super admin only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+
+    if user_id != config.super_admin:
+        return
+
+    task = context.bot_data.get("announcement_task")
+    running = task is not None and not task.done()
+
+    if context.args and context.args[0] == "cancel":
+        if not running:
+            await update.message.reply_text("📭 هیچ اطلاعیه‌ای در حال ارسال نیست.")
+            return
+        job = context.bot_data["announcement_job"]
+        job["cancelled"] = True
+        job["cursor"] = len(job["recipients"])
+        task.cancel()
+        await update.message.reply_text("⛔️ ارسال اطلاعیه متوقف شد.")
+        return
+
+    if not context.args:
+        await update.message.reply_text(
+            "📢 *نحوه ارسال اطلاعیه به همه کاربران:*\n"
+            "`/announce متن اطلاعیه`\n\n"
+            "برای توقف ارسال: `/announce cancel`",
+            parse_mode="Markdown"
+        )
+        return
+
+    if running:
+        await update.message.reply_text(
+            format_announcement_progress(context.bot_data["announcement_job"]),
+            parse_mode="Markdown"
+        )
+        return
+
+    recipients = collect_announcement_recipients(context.bot_data)
+    if not recipients:
+        await update.message.reply_text("📭 هیچ کاربری برای ارسال اطلاعیه وجود ندارد.")
+        return
+
+    job = {
+        "id": str(int(datetime.now().timestamp())),
+        "text": (
+            f"📢 *اطلاعیه کلاب مالی آرکاکوین*\n\n"
+            f"{' '.join(context.args)}"
+        ),
+        "recipients": recipients,
+        "cursor": 0,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "status_chat_id": update.message.chat_id,
+    }
+    status_message = await update.message.reply_text(
+        format_announcement_progress(job), parse_mode="Markdown"
+    )
+    job["status_message_id"] = status_message.message_id
+
+    await save_announcement_checkpoint(context.application, job)
+    start_announcement(context.application, job)
+
 async def list_all_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all admins (Super admin only)"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id != SUPER_ADMIN:
+    if user_id != config.super_admin:
         return
     
-    all_admins = set(PRIMARY_ADMINS + SECONDARY_ADMINS)
+    all_admins = set(config.primary_admins + config.secondary_admins)
     
     admin_list = "👥 *لیست تمامی ادمین‌ها:*\n\n"
     
-    if PRIMARY_ADMINS:
+    if config.primary_admins:
         admin_list += "👑 *ادمین‌های اصلی:*\n"
-        for admin_id in PRIMARY_ADMINS:
-            admin_name = get_admin_name(admin_id)
+        for admin_id in config.primary_admins:
+            admin_name = config.admin_name(admin_id)
             admin_list += f"• `{admin_id}` - {admin_name}\n"
         admin_list += "\n"
     
-    if SECONDARY_ADMINS:
+    if config.secondary_admins:
         admin_list += "🔧 *ادمین‌های سطح دو:*\n"
-        for admin_id in SECONDARY_ADMINS:
-            admin_name = get_admin_name(admin_id)
+        for admin_id in config.secondary_admins:
+            admin_name = config.admin_name(admin_id)
             admin_list += f"• `{admin_id}` - {admin_name}\n"
     
     admin_list += f"\n📊 کل ادمین‌ها: {len(all_admins)}"
@@ -1017,9 +2877,10 @@ async def list_all_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def my_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show personal status for secondary admins"""
+    config = get_config(context)
     user_id = str(update.message.from_user.id)
     
-    if user_id not in SECONDARY_ADMINS:
+    if user_id not in config.secondary_admins:
         await update.message.reply_text("❌ این دستور فقط برای ادمین‌های سطح دو است.")
         return
     
@@ -1028,7 +2889,7 @@ async def my_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                    if data.get("delegated_to") == user_id]
     
     if not my_messages:
-        admin_name = get_admin_name(user_id)
+        admin_name = config.admin_name(user_id)
         await update.message.reply_text(f"📭 {admin_name} عزیز، شما هیچ تسکی ندارید.")
         return
     
@@ -1038,7 +2899,7 @@ async def my_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answered = len([m for m in my_messages if m.get("admin_reply")])
     pending = total - completed
     
-    admin_name = get_admin_name(user_id)
+    admin_name = config.admin_name(user_id)
     
     status_msg = (
         f"👤 *وضعیت شخصی {admin_name}*\n\n"
@@ -1071,37 +2932,1105 @@ async def my_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(status_msg, parse_mode="Markdown")
 
+class Outbox:
+    """Durable queue for outbound Bot API calls
+
+    Entries are kept in memory and journaled to DATA_DIR/outbox.jsonl by
+    flush(), which runs every OUTBOX_FLUSH_INTERVAL seconds in a worker
+    thread, so enqueueing never touches the disk. The delivery worker keeps
+    per-chat order, retries with exponential backoff and moves entries that
+    keep failing (or fail permanently) to the dead-letter list.
+    """
+
+    def __init__(self):
+        self.bots: Dict[str, object] = {}
+        self.delivery_hooks: Dict[str, object] = {}
+        self.queue: "OrderedDict[str, Dict]" = OrderedDict()
+        self.keys: "OrderedDict[str, None]" = OrderedDict()
+        self.dead: List[Dict] = []
+        self.journal: List[str] = []
+        self.dead_dirty = False
+        self.concurrency = OUTBOX_CONCURRENCY
+        self.wakeup = asyncio.Event()
+
+    def enqueue(self, tenant: str, method: str, chat_id, key: Optional[str] = None,
+                route: Optional[str] = None, keyboard: Optional[str] = None, **kwargs) -> Optional[str]:
+        """Queue a call of tenant's bot; calls repeating an already seen key are dropped
+
+        route and keyboard are ticket IDs for the tenant's delivery hook: the
+        sent message belongs to that ticket, or carries its delegation keyboard.
+        """
+        if key is not None:
+            key = f"{tenant}:{key}"
+            if key in self.keys:
+                logger.info(f"Outbox dropped duplicate {key}")
+                return None
+            self.remember_key(key)
+        entry = {
+            "id": uuid.uuid4().hex,
+            "tenant": tenant,
+            "key": key,
+            "route": route,
+            "keyboard": keyboard,
+            "method": method,
+            "chat_id": str(chat_id),
+            "kwargs": kwargs,
+            "attempts": 0,
+            "next_attempt": 0.0,
+            "created": time.time(),
+        }
+        self.queue[entry["id"]] = entry
+        self.journal.append(json.dumps({"op": "add", "entry": entry}, ensure_ascii=False))
+        self.wakeup.set()
+        return entry["id"]
+
+    def remember_key(self, key: str) -> None:
+        self.keys[key] = None
+        while len(self.keys) > OUTBOX_DEDUP_KEYS:
+            self.keys.popitem(last=False)
+
+    def ready_batch(self) -> List[Dict]:
+        """Head entry of each chat whose retry time has come, up to self.concurrency
+
+        Entries of bots that are not registered (yet) are left in the queue.
+        """
+        now = time.time()
+        seen_chats = set()
+        batch = []
+        for entry in self.queue.values():
+            chat = (entry["tenant"], entry["chat_id"])
+            if chat in seen_chats or entry["tenant"] not in self.bots:
+                continue
+            seen_chats.add(chat)
+            if entry["next_attempt"] <= now:
+                batch.append(entry)
+                if len(batch) >= self.concurrency:
+                    break
+        return batch
+
+    def next_wakeup(self) -> Optional[float]:
+        """Seconds until the earliest scheduled retry, None if no registered bot has entries"""
+        # Like ready_batch, skip unregistered bots: a due entry nobody can send would spin the worker
+        due = [e["next_attempt"] for e in self.queue.values() if e["tenant"] in self.bots]
+        if not due:
+            return None
+        return max(0.0, min(due) - time.time())
+
+    async def deliver(self, entry: Dict) -> None:
+        bot = self.bots[entry["tenant"]]
+        entry["attempts"] += 1
+        kwargs = entry["kwargs"]
+        if entry["method"] == "send_media_group":
+            kwargs = {**kwargs, "media": [input_media(item) for item in kwargs["media"]]}
+        try:
+            # By keyword: edit_message_text takes text first
+            message = await getattr(bot, entry["method"])(chat_id=entry["chat_id"], **kwargs)
+        except RetryAfter as e:
+            entry["attempts"] -= 1  # flood control is not the entry's fault
+            entry["next_attempt"] = time.time() + retry_after_seconds(e)
+            return
+        except (Forbidden, BadRequest) as e:
+            self.bury(entry, str(e))
+            return
+        except TelegramError as e:
+            if entry["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                self.bury(entry, str(e))
+                return
+            delay = min(OUTBOX_BASE_DELAY * 2 ** (entry["attempts"] - 1), OUTBOX_MAX_DELAY)
+            entry["next_attempt"] = time.time() + delay
+            logger.warning(f"Outbox {entry['method']} to {entry['chat_id']} failed ({e}), retrying in {delay}s")
+            return
+        except Exception as e:
+            # Not retried: a journaled entry the bot can't take (say, bad kwargs) would fail forever,
+            # and raising here would end the delivery worker
+            self.bury(entry, f"{type(e).__name__}: {e}")
+            return
+
+        del self.queue[entry["id"]]
+        self.journal.append(json.dumps({"op": "done", "id": entry["id"]}))
+
+        hook = self.delivery_hooks.get(entry["tenant"])
+        if hook is not None:
+            try:
+                hook(entry, message)
+            except Exception as e:
+                logger.error(f"Outbox delivery hook failed for {entry['method']} to {entry['chat_id']}: {e}")
+
+    def bury(self, entry: Dict, error: str) -> None:
+        """Move an entry to the dead-letter list"""
+        logger.error(f"Outbox giving up on {entry['method']} to {entry['chat_id']}: {error}")
+        del self.queue[entry["id"]]
+        entry["error"] = error
+        entry["failed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M")
+        self.dead.append(entry)
+        del self.dead[:-OUTBOX_DEAD_LETTER_LIMIT]
+        self.dead_dirty = True
+        self.journal.append(json.dumps({"op": "done", "id": entry["id"]}))
+
+    def bury_orphans(self) -> int:
+        """Dead-letter entries of bots that are not registered, once all of them are
+
+        These are left by a bot removed from TENANTS_FILE, or by switching
+        between single-bot mode (bot "") and multi-bot mode.
+        """
+        orphans = [entry for entry in self.queue.values() if entry["tenant"] not in self.bots]
+        for entry in orphans:
+            self.bury(entry, f"unknown bot '{entry['tenant']}'")
+        if orphans:
+            logger.warning(f"Outbox moved {len(orphans)} entries of unknown bots to the dead letters")
+        return len(orphans)
+
+    def dead_letters(self, tenant: str) -> List[Dict]:
+        return [entry for entry in self.dead if entry["tenant"] == tenant]
+
+    def pending_count(self, tenant: str) -> int:
+        return sum(1 for entry in self.queue.values() if entry["tenant"] == tenant)
+
+    def retry_dead(self, tenant: str) -> int:
+        """Requeue every dead letter of a bot with a fresh attempt budget"""
+        retry = self.dead_letters(tenant)
+        for entry in retry:
+            entry.pop("error", None)
+            entry.pop("failed_at", None)
+            entry["attempts"] = 0
+            entry["next_attempt"] = 0.0
+            self.queue[entry["id"]] = entry
+            self.journal.append(json.dumps({"op": "add", "entry": entry}, ensure_ascii=False))
+        self.dead = [entry for entry in self.dead if entry["tenant"] != tenant]
+        self.dead_dirty = True
+        self.wakeup.set()
+        return len(retry)
+
+    async def run(self) -> None:
+        """Delivery worker, shared by every registered bot"""
+        while True:
+            batch = self.ready_batch()
+            if batch:
+                await asyncio.gather(*(self.deliver(entry) for entry in batch))
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.next_wakeup())
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush(self) -> None:
+        """Append buffered journal records and save dead letters, off the event loop"""
+        if self.journal:
+            lines, self.journal = self.journal, []
+            await asyncio.to_thread(append_journal, OUTBOX_JOURNAL, lines)
+        if self.dead_dirty:
+            self.dead_dirty = False
+            payload = json.dumps(self.dead, ensure_ascii=False)
+            await asyncio.to_thread(write_state, OUTBOX_DEAD_LETTER_STATE, payload)
+
+    async def flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.error(f"Error flushing outbox: {e}")
+
+    def load(self) -> None:
+        """Replay the journal, then rewrite it with the undelivered entries and the last OUTBOX_DEDUP_KEYS keys"""
+        try:
+            with open(data_path(OUTBOX_JOURNAL), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    if record["op"] == "add":
+                        entry = record["entry"]
+                        entry.setdefault("tenant", "")
+                        self.queue[entry["id"]] = entry
+                        if entry.get("key"):
+                            self.remember_key(entry["key"])
+                    elif record["op"] == "done":
+                        self.queue.pop(record["id"], None)
+                    elif record["op"] == "key":
+                        self.remember_key(record["key"])
+        except FileNotFoundError:
+            pass
+        self.dead = load_state(OUTBOX_DEAD_LETTER_STATE, [])
+        # Keys of delivered entries are kept too, so a replayed update is still recognised after the next restart
+        queued_keys = {e.get("key") for e in self.queue.values()}
+        write_state(OUTBOX_JOURNAL, "".join(
+            [json.dumps({"op": "key", "key": k}, ensure_ascii=False) + "\n" for k in self.keys if k not in queued_keys]
+            + [json.dumps({"op": "add", "entry": e}, ensure_ascii=False) + "\n" for e in self.queue.values()]
+        ))
+        if self.queue:
+            logger.info(f"Outbox restored {len(self.queue)} undelivered messages")
+
+def append_journal(name: str, lines: List[str]) -> None:
+    """Append lines to a journal file and fsync it"""
+    with open(data_path(name), "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def get_outbox(context) -> Outbox:
+    return context.bot_data["outbox"]
+
+def outbox_send(context, method: str, chat_id, key: Optional[str] = None,
+                route: Optional[str] = None, keyboard: Optional[str] = None, **kwargs) -> Optional[str]:
+    """Queue a call of this bot's method in the (possibly shared) outbox"""
+    return get_outbox(context).enqueue(
+        get_config(context).name, method, chat_id, key=key, route=route, keyboard=keyboard, **kwargs
+    )
+
+async def list_dead_letters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or retry messages the outbox gave up on (Primary admins only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+    if user_id not in config.primary_admins:
+        return
+
+    outbox = get_outbox(context)
+
+    if context.args and context.args[0] == "retry":
+        count = outbox.retry_dead(config.name)
+        await update.message.reply_text(f"🔁 {count} پیام دوباره در صف ارسال قرار گرفت.")
+        return
+
+    dead = outbox.dead_letters(config.name)
+    queued = outbox.pending_count(config.name)
+    if not dead:
+        await update.message.reply_text(
+            f"📭 هیچ پیام ناموفقی وجود ندارد.\n📤 در صف ارسال: {queued}"
+        )
+        return
+
+    msg = f"📮 پیام‌های ناموفق ({len(dead)}):\n\n"
+    for entry in dead[-10:]:
+        content = entry["kwargs"].get("text") or entry["kwargs"].get("caption") or entry["method"]
+        msg += (
+            f"🆔 {entry['chat_id']} - {entry['failed_at']}\n"
+            f"📝 {content[:100]}\n"
+            f"❌ {entry['error']}\n\n"
+        )
+    msg += f"📤 در صف ارسال: {queued}\n"
+    msg += "برای ارسال مجدد همه: /deadletters retry"
+
+    await update.message.reply_text(msg)
+
+def on_outbox_delivery(application, entry: Dict, message) -> None:
+    """Index what the outbox sent: routed messages for replies, delegation keyboards for later edits"""
+    bot_data = application.bot_data
+    sent = [m for m in (message if isinstance(message, (list, tuple)) else [message]) if isinstance(m, Message)]
+    if entry.get("route"):
+        for m in sent:
+            bot_data["routes"].add(entry["chat_id"], m.message_id, entry["route"])
+
+    ticket_id = entry.get("keyboard")
+    ticket = bot_data["pending_messages"].get(ticket_id) if ticket_id else None
+    if ticket is None or not sent:
+        return
+    if is_unassigned(ticket):
+        update_ticket(bot_data, ticket, keyboards={**ticket.get("keyboards", {}), entry["chat_id"]: sent[0].message_id})
+    else:
+        # Claimed or closed while the keyboard waited in the queue
+        bot_data["outbox"].enqueue(
+            entry["tenant"], "edit_message_text", entry["chat_id"],
+            key=f"keyboard:{ticket_id}:{entry['chat_id']}:stale",
+            text=delegation_status_text(bot_data["config"], ticket), message_id=sent[0].message_id
+        )
+
+async def post_init(application):
+    """Restore persisted state and resume interrupted background jobs"""
+    application.bot_data["blocked_users"] = set(load_state(state_file(application, BLOCKED_USERS_STATE), []))
+    application.bot_data["rollups"] = load_state(state_file(application, ROLLUP_STATE), {"hourly": {}, "daily": {}})
+    application.bot_data["latency"] = {
+        dimension: {metric: LatencySketch(bins) for metric, bins in sketches.items()}
+        for dimension, sketches in load_state(state_file(application, LATENCY_STATE), {}).items()
+    }
+    application.bot_data["pending_messages"] = load_state(state_file(application, TICKETS_STATE), {})
+    logger.info(f"Restored {len(application.bot_data['pending_messages'])} tickets")
+    queue = TicketQueue()
+    for message_id, data in application.bot_data["pending_messages"].items():
+        if is_unassigned(data):
+            queue.push(message_id, data)
+    application.bot_data["ticket_queue"] = queue
+    application.bot_data["ticket_index"] = TicketIndex(application.bot_data["pending_messages"])
+    start_background_task(application, state_flush_loop(application), name="state_flush")
+    if admin_config_path():
+        start_background_task(application, admin_config_watch_loop(application, admin_config_path()), name="admin_reload")
+
+    # In multi-bot mode the host has already put the shared, running outbox into bot_data
+    outbox = application.bot_data.get("outbox")
+    owns_outbox = outbox is None
+    if owns_outbox:
+        outbox = Outbox()
+        await asyncio.to_thread(outbox.load)
+        application.bot_data["outbox"] = outbox
+        start_background_task(application, outbox.flush_loop(), name="outbox_flush")
+        start_background_task(
+            application,
+            transport_autoscale_loop(application.bot_data["transport"]["send"], outbox),
+            name="transport_autoscale"
+        )
+        start_background_task(application, loop_watchdog(), name="loop_watchdog")
+        if DASHBOARD_PORT:
+            application.bot_data["dashboard"] = Dashboard(DASHBOARD_HOST, DASHBOARD_PORT)
+            start_background_task(application, application.bot_data["dashboard"].serve(), name="dashboard")
+    if "dashboard" in application.bot_data:
+        application.bot_data["dashboard"].apps[application.bot_data["config"].name] = application
+    application.bot_data["flood"] = FloodGuard()
+    application.bot_data["debouncer"] = Debouncer()
+    application.bot_data["relay_bursts"] = {}
+
+    routes = RouteIndex(load_state(state_file(application, ROUTES_STATE), []))
+    application.bot_data["routes"] = routes
+    outbox.bots[application.bot_data["config"].name] = application.bot
+    outbox.delivery_hooks[application.bot_data["config"].name] = (
+        lambda entry, message: on_outbox_delivery(application, entry, message)
+    )
+    if owns_outbox:
+        # Only now that this bot is registered: its entries would not be delivered before
+        outbox.bury_orphans()
+        start_background_task(application, outbox.run(), name="outbox_worker")
+
+    transcripts = TranscriptLog(state_file(application, "transcripts"))
+    await asyncio.to_thread(transcripts.load)
+    application.bot_data["transcripts"] = transcripts
+    start_background_task(application, transcripts.flush_loop(), name="transcript_flush")
+
+    job = load_state(state_file(application, ANNOUNCEMENT_STATE))
+    if job and not job.get("done") and not job.get("cancelled"):
+        logger.info(f"Resuming announcement {job['id']} at {job['cursor']}/{len(job['recipients'])}")
+        start_announcement(application, job)
+
+async def post_stop(application):
+    """Cancel background jobs and snapshot state
+
+    Runs after PTB has stopped polling and finished processing every update it
+    already fetched, so in-flight admin fan-outs are complete at this point;
+    debounced sends still waiting for their window are run now.
+    Background jobs checkpoint their own progress on cancellation, and
+    undelivered outbox entries are journaled for the next start.
+    """
+    tasks = list(application.bot_data.get("background_tasks", ()))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await application.bot_data["debouncer"].flush()
+    await flush_rollups(application)
+    await flush_latency(application)
+    await snapshot_tickets(application, force=True)
+    await flush_routes(application)
+    await application.bot_data["transcripts"].flush()
+    await application.bot_data["outbox"].flush()
+    logger.info("State snapshot written, shutdown complete")
+
+class SQLitePersistence(BasePersistence):
+    """Stores user_data drafts and ConversationHandler states in SQLite, one row per key
+
+    PTB hands over the users and conversations that changed every
+    update_interval seconds; those are staged and written in one transaction
+    in a worker thread, so a flush costs what changed rather than everything.
+    A user's data is read on their first update, not at startup. bot_data
+    keeps its own JSON snapshots (see post_init) and is not stored here.
+    """
+
+    def __init__(self, path: str, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.loaded_users = set()
+        self.dirty_users: Dict[int, Optional[str]] = {}  # user_id -> JSON, None to delete
+        self.dirty_conversations: Dict[tuple, Optional[str]] = {}  # (name, key) -> JSON state, None to delete
+        self.writer: Optional[asyncio.Task] = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))"
+            )
+        return self.db
+
+    def query(self, sql: str, params=()) -> List:
+        with self.lock:
+            return self.connect().execute(sql, params).fetchall()
+
+    def write(self, users: Dict, conversations: Dict) -> None:
+        with self.lock:
+            db = self.connect()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                    [(user_id, data) for user_id, data in users.items() if data is not None]
+                )
+                db.executemany(
+                    "DELETE FROM user_data WHERE user_id = ?",
+                    [(user_id,) for user_id, data in users.items() if data is None]
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+                )
+                db.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [(name, key) for (name, key), state in conversations.items() if state is None]
+                )
+
+    def schedule_write(self) -> None:
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.write_dirty())
+
+    async def write_dirty(self) -> None:
+        # Let the rest of PTB's persistence pass stage its keys first, so they share one transaction
+        await asyncio.sleep(0)
+        while self.dirty_users or self.dirty_conversations:
+            users, self.dirty_users = self.dirty_users, {}
+            conversations, self.dirty_conversations = self.dirty_conversations, {}
+            await asyncio.to_thread(self.write, users, conversations)
+
+    async def get_user_data(self) -> Dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        if user_id in self.loaded_users:
+            return
+        self.loaded_users.add(user_id)
+        rows = await asyncio.to_thread(self.query, "SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+        if rows:
+            user_data.update(json.loads(rows[0][0]))
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self.loaded_users.add(user_id)
+        self.dirty_users[user_id] = json.dumps(data, ensure_ascii=False) if data else None
+        self.schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.dirty_users[user_id] = None
+        self.schedule_write()
+
+    async def get_conversations(self, name: str) -> Dict:
+        rows = await asyncio.to_thread(self.query, "SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self.dirty_conversations[(name, json.dumps(key))] = None if new_state is None else json.dumps(new_state)
+        self.schedule_write()
+
+    async def flush(self) -> None:
+        if self.writer is not None:
+            await self.writer
+        await self.write_dirty()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    # Chat data, bot data and callback data are not stored (see store_data)
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+class BacklogUpdateProcessor(SimpleUpdateProcessor):
+    """Processes updates one at a time, pacing the backlog that queued up while the bot was down
+
+    Updates whose message predates startup are spread out to BACKLOG_RATE per
+    second so the replies they trigger don't hit flood control; pacing is
+    switched off at the first update that arrived after startup, and when
+    polling stops so shutdown doesn't wait for it. A backlog update waits for
+    its turn outside the processing slot, so live updates from other chats
+    go ahead of it; updates from the same chat keep their order.
+    """
+
+    def __init__(self, rate: float):
+        # PTB only hands updates over concurrently above 1; self.slot still runs one at a time
+        super().__init__(max_concurrent_updates=BACKLOG_MAX_WAITING)
+        self.started_at = datetime.now(timezone.utc)
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.backlog_count = 0
+        self.draining = True
+        self.slot = asyncio.Lock()
+        self.chat_tails: Dict[object, asyncio.Future] = {}
+        self.updater = None  # set by build_application
+
+    def is_backlog(self, update: object) -> bool:
+        message = update.effective_message if isinstance(update, Update) else None
+        return message is not None and message.date is not None and message.date < self.started_at
+
+    def polling(self) -> bool:
+        return self.updater is not None and self.updater.running
+
+    async def pace(self) -> None:
+        self.backlog_count += 1
+        turn = max(self.next_slot, time.monotonic())
+        self.next_slot = turn + self.interval
+        while self.polling() and turn > time.monotonic():
+            await asyncio.sleep(min(turn - time.monotonic(), 0.5))
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+        previous = self.chat_tails.get(chat)
+        done = asyncio.get_running_loop().create_future()
+        self.chat_tails[chat] = done
+        try:
+            if self.draining:
+                if self.is_backlog(update):
+                    await self.pace()
+                else:
+                    self.draining = False
+                    logger.info(f"Processed backlog of {self.backlog_count} updates")
+            if previous is not None:
+                await previous
+            async with self.slot:
+                await coroutine
+        finally:
+            done.set_result(None)
+            if self.chat_tails.get(chat) is done:
+                del self.chat_tails[chat]
+
 async def check_active_conversation_first(update, context):
     if await handle_user_active_conversation(update, context):
         return 
     return 
 
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    
-    all_admins = SECONDARY_ADMINS + PRIMARY_ADMINS
-    if SUPER_ADMIN:
-        all_admins.append(SUPER_ADMIN)
+class TransportRequest(BaseRequest):
+    """Connection pool with a tunable, resizable size and usage metrics
+
+    Requests go through an HTTPXRequest, which resize() replaces with a
+    bigger one. One instance can be shared by several bots; the pool is only
+    closed when the last of them shuts down.
+    """
+
+    def __init__(self, pool_size: int, pool_timeout: float):
+        http_version = HTTP_VERSION
+        if http_version != "1.1" and importlib.util.find_spec("h2") is None:
+            logger.warning("HTTP/2 needs `pip install httpx[http2]`, falling back to HTTP/1.1")
+            http_version = "1.1"
+        self.http_version = http_version
+        self.pool_timeout = pool_timeout
+        self.pool_size = pool_size
+        self.client = self.build_client(pool_size)
+        self.users = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.pool_timeouts = 0
+        self.retired_clients = set()
+
+    def build_client(self, size: int) -> HTTPXRequest:
+        return HTTPXRequest(
+            connection_pool_size=size,
+            pool_timeout=self.pool_timeout,
+            http_version=self.http_version,
+            httpx_kwargs={"limits": self.pool_limits(size)},
+        )
+
+    @staticmethod
+    def pool_limits(size: int) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=size,
+            max_keepalive_connections=size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.client.read_timeout
+
+    async def initialize(self) -> None:
+        self.users += 1
+        await self.client.initialize()
+
+    async def shutdown(self) -> None:
+        self.users -= 1
+        if self.users <= 0:
+            await self.client.shutdown()
+
+    async def do_request(self, *args, **kwargs):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await self.client.do_request(*args, **kwargs)
+        except TimedOut as e:
+            self.errors += 1
+            if "Pool timeout" in str(e):
+                self.pool_timeouts += 1
+            raise
+        except TelegramError:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def resize(self, size: int) -> None:
+        """Swap in a client with a bigger pool; the old one closes once its requests are done"""
+        logger.info(f"Resizing HTTP connection pool {self.pool_size} -> {size}")
+        client = self.build_client(size)
+        await client.initialize()
+        old_client, self.client = self.client, client
+        self.pool_size = size
+        task = asyncio.create_task(self.close_later(old_client))
+        self.retired_clients.add(task)
+        task.add_done_callback(self.retired_clients.discard)
+
+    async def close_later(self, client: HTTPXRequest) -> None:
+        await asyncio.sleep(HTTP_RETIRE_GRACE)
+        await client.shutdown()
+
+    def metrics(self) -> Dict:
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "pool_timeouts": self.pool_timeouts,
+            "http_version": self.http_version,
+        }
+
+def build_send_request() -> TransportRequest:
+    """Pool for outbound calls, which several bots may share"""
+    return TransportRequest(SEND_POOL_SIZE, SEND_POOL_TIMEOUT)
+
+def build_transport(send_request: Optional[TransportRequest] = None) -> Dict[str, TransportRequest]:
+    """Separate pools for long-polling getUpdates and for outbound calls; send_request is reused if given"""
+    return {
+        "updates": TransportRequest(UPDATES_POOL_SIZE, UPDATES_POOL_TIMEOUT),
+        "send": send_request if send_request is not None else build_send_request(),
+    }
+
+async def transport_autoscale_loop(request: TransportRequest, outbox: "Outbox") -> None:
+    """Grow the outbound pool (and the outbox's concurrency) while the outbox backs up"""
+    last_pool_timeouts = request.pool_timeouts
+    while True:
+        await asyncio.sleep(SEND_POOL_CHECK_INTERVAL)
+        backed_up = len(outbox.queue) >= SEND_POOL_GROW_BACKLOG
+        saturated = (
+            request.in_flight >= request.pool_size * 0.8
+            or request.pool_timeouts > last_pool_timeouts
+        )
+        last_pool_timeouts = request.pool_timeouts
+        if backed_up and saturated and request.pool_size < SEND_POOL_MAX_SIZE:
+            size = min(request.pool_size * 2, SEND_POOL_MAX_SIZE)
+            await request.resize(size)
+            outbox.concurrency = max(outbox.concurrency, size - SEND_POOL_RESERVED)
 
-    all_admin_ids = [int(aid) for aid in all_admins if aid.isdigit()]
+def deep_size(obj) -> int:
+    """Approximate bytes held by obj and the dicts, lists, sets and tuples inside it"""
+    size = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+def approx_size(values: List) -> int:
+    """deep_size of a spread-out sample of values, scaled to all of them"""
+    if not values:
+        return 0
+    picked = values[::max(1, len(values) // MEMSTATS_SAMPLE)][:MEMSTATS_SAMPLE]
+    return int(sum(deep_size(v) for v in picked) * len(values) / len(picked))
+
+def process_rss() -> Optional[int]:
+    """Resident memory of this process in bytes, where /proc is available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def format_bytes(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f} MiB"
+    return f"{size / 1024:.1f} KiB"
+
+def memory_stats(application) -> Dict:
+    """Approximate size and count of each structure the bot keeps in memory"""
+    bot_data = application.bot_data
+    tickets = {"new": [], "delegated": [], "completed": []}
+    for data in bot_data.get("pending_messages", {}).values():
+        if data.get("completed"):
+            tickets["completed"].append(data)
+        elif data.get("delegated_to"):
+            tickets["delegated"].append(data)
+        else:
+            tickets["new"].append(data)
+
+    user_data = list(application.user_data.values())
+    drafts = [data for data in user_data if data.get("messages")]
+    stats = {
+        "rss": process_rss(),
+        "tickets": {status: {"count": len(items), "bytes": approx_size(items)} for status, items in tickets.items()},
+        "drafts": {
+            "count": len(drafts),
+            "items": sum(len(data["messages"]) for data in drafts),
+            "bytes": approx_size(drafts),
+        },
+        "user_data": {"count": len(user_data), "bytes": approx_size(user_data)},
+        "chat_data": {"count": len(application.chat_data), "bytes": approx_size(list(application.chat_data.values()))},
+        "caches": {},
+    }
+
+    caches = stats["caches"]
+    routes = bot_data.get("routes")
+    if routes is not None:
+        caches["routes"] = {"count": len(routes.routes), "bytes": approx_size(list(routes.routes.items()))}
+    transcripts = bot_data.get("transcripts")
+    if transcripts is not None:
+        caches["transcript_index"] = {
+            "count": len(transcripts.index), "bytes": approx_size(list(transcripts.index.items()))
+        }
+    rollups = bot_data.get("rollups")
+    if rollups is not None:
+        buckets = list(rollups["hourly"].items()) + list(rollups["daily"].items())
+        caches["rollups"] = {"count": len(buckets), "bytes": approx_size(buckets)}
+    latency = bot_data.get("latency")
+    if latency is not None:
+        bins = [sketch.bins for sketches in latency.values() for sketch in sketches.values()]
+        caches["latency_sketches"] = {"count": len(bins), "bytes": approx_size(bins)}
+    flood = bot_data.get("flood")
+    if flood is not None:
+        caches["flood_buckets"] = {
+            "count": len(flood.buckets) + len(flood.muted),
+            "bytes": approx_size(list(flood.buckets.items()) + list(flood.muted.items())),
+        }
+    queue = bot_data.get("ticket_queue")
+    if queue is not None:
+        caches["ticket_queue"] = {"count": len(queue), "bytes": approx_size([e for heap in queue.heaps.values() for e in heap])}
+    bursts = bot_data.get("relay_bursts")
+    if bursts is not None:
+        caches["relay_bursts"] = {"count": len(bursts), "bytes": approx_size(list(bursts.values()))}
+    outbox = bot_data.get("outbox")
+    if outbox is not None:
+        # Shared by every bot in multi-bot mode
+        caches["outbox_queue"] = {"count": len(outbox.queue), "bytes": approx_size(list(outbox.queue.values()))}
+        caches["outbox_keys"] = {"count": len(outbox.keys), "bytes": approx_size(list(outbox.keys))}
+        caches["dead_letters"] = {"count": len(outbox.dead), "bytes": approx_size(outbox.dead)}
+    return stats
+
+def top_allocators(snapshot: tracemalloc.Snapshot) -> List[str]:
+    lines = []
+    for stat in snapshot.statistics("lineno")[:MEMSTATS_TOP]:
+        frame = stat.traceback[0]
+        lines.append(f"{format_bytes(stat.size)} ({stat.count}) {os.path.basename(frame.filename)}:{frame.lineno}")
+    return lines
+
+async def show_memstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show memory use by structure; `trace` adds tracemalloc's top allocators (Super admin only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+
+    if user_id != config.super_admin:
+        return
+
+    if context.args and context.args[0] == "trace":
+        if len(context.args) > 1 and context.args[1] == "stop":
+            tracemalloc.stop()
+            await update.message.reply_text("⏹️ ردیابی حافظه متوقف شد.")
+        elif not tracemalloc.is_tracing():
+            # Tracing slows every allocation, so it only runs between `trace` and `trace stop`
+            tracemalloc.start()
+            await update.message.reply_text(
+                "▶️ ردیابی حافظه شروع شد. بعد از مدتی دوباره `/memstats trace` را بفرستید.\n"
+                "برای توقف: `/memstats trace stop`",
+                parse_mode="Markdown"
+            )
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            lines = await asyncio.to_thread(top_allocators, snapshot)
+            await update.message.reply_text(
+                "🔬 بیشترین تخصیص‌های حافظه (از شروع ردیابی):\n\n" + "\n".join(lines)
+            )
+        return
+
+    stats = memory_stats(context.application)
+    status_labels = {"new": "🆕 جدید", "delegated": "🔄 ارجاع شده", "completed": "✅ تکمیل شده"}
+    msg = "🧠 آمار حافظه\n\n"
+    if stats["rss"] is not None:
+        msg += f"💾 حافظه پروسه: {format_bytes(stats['rss'])}\n\n"
+    msg += "📩 تیکت‌ها:\n"
+    for status, entry in stats["tickets"].items():
+        msg += f"  {status_labels[status]}: {entry['count']} ({format_bytes(entry['bytes'])})\n"
+    msg += (
+        f"\n📝 پیش‌نویس‌ها: {stats['drafts']['count']} کاربر، {stats['drafts']['items']} پیام "
+        f"({format_bytes(stats['drafts']['bytes'])})\n"
+        f"👤 user_data: {stats['user_data']['count']} ({format_bytes(stats['user_data']['bytes'])})\n"
+        f"💬 chat_data: {stats['chat_data']['count']} ({format_bytes(stats['chat_data']['bytes'])})\n\n"
+        "🗃️ کش‌ها:\n"
+    )
+    for name, entry in stats["caches"].items():
+        msg += f"  {name}: {entry['count']} ({format_bytes(entry['bytes'])})\n"
+
+    objects = gc.get_objects()
+    counts = Counter(type(obj).__name__ for obj in objects)
+    msg += f"\n🔢 اشیای ردیابی‌شده توسط gc: {len(objects)}\n"
+    for name, count in counts.most_common(MEMSTATS_TOP):
+        msg += f"  {name}: {count}\n"
+    del objects
+
+    await update.message.reply_text(msg)
+
+def collect_metrics(application) -> Dict:
+    """Operational metrics of one bot, exported to DATA_DIR and shown by /metrics"""
+    transport = application.bot_data.get("transport", {})
+    outbox = application.bot_data.get("outbox")
+    name = application.bot_data["config"].name
+    metrics = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "transport": {kind: request.metrics() for kind, request in transport.items()},
+    }
+    if outbox is not None:
+        metrics["outbox"] = {
+            "queued": outbox.pending_count(name),
+            "queued_all_bots": len(outbox.queue),
+            "dead_letters": len(outbox.dead_letters(name)),
+            "concurrency": outbox.concurrency,
+        }
+    flood = application.bot_data.get("flood")
+    if flood is not None:
+        metrics["flood"] = {
+            "dropped": flood.dropped,
+            "mutes": flood.mutes,
+            "muted": len(flood.muted),
+            "buckets": len(flood.buckets),
+        }
+    metrics["memory"] = memory_stats(application)
+    return metrics
+
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show operational metrics (Super admin only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+
+    if user_id != config.super_admin:
+        return
+
+    metrics = collect_metrics(context.application)
+    await update.message.reply_text(
+        f"📈 *متریک‌های ربات*\n```\n{json.dumps(metrics, indent=2)}\n```",
+        parse_mode="Markdown"
+    )
+
+def collapse_stack(frame) -> str:
+    """One line of a collapsed-stack (flamegraph) profile, outermost call first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler(threading.Thread):
+    """Samples the event loop thread's stack from a side thread
+
+    The loop itself runs no profiling code, so handlers run at normal speed;
+    while the loop waits for I/O the samples land in the selector's select().
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+            del frame
+
+class LoopWatchdog(threading.Thread):
+    """Logs where the event loop is stuck when it misses its heartbeat for `threshold` seconds"""
+
+    def __init__(self, thread_id: int, threshold: float):
+        super().__init__(name="loop_watchdog", daemon=True)
+        self.thread_id = thread_id
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.stalls = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        reported = False
+        while not self.stopped.wait(self.threshold / 4):
+            blocked = time.monotonic() - self.last_beat
+            if blocked < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            del frame
+            logger.warning(f"Event loop blocked for {blocked * 1000:.0f}ms, currently at:\n{stack}")
+
+async def loop_watchdog() -> None:
+    """Heartbeat for LoopWatchdog; one per process, since all bots share the loop"""
+    if SLOW_CALLBACK_MS <= 0:
+        return
+    watchdog = LoopWatchdog(threading.get_ident(), SLOW_CALLBACK_MS / 1000)
+    watchdog.start()
+    try:
+        while True:
+            watchdog.last_beat = time.monotonic()
+            await asyncio.sleep(watchdog.threshold / 4)
+    finally:
+        watchdog.stopped.set()
+
+async def run_profile(application, chat_id: int, seconds: int) -> None:
+    """Sample the event loop for `seconds` and send the collapsed stacks to chat_id"""
+    profiler = SamplingProfiler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stopped.set()
+        await asyncio.to_thread(profiler.join)
+        application.bot_data.pop("profiling", None)
+
+    samples = profiler.samples
+    total = sum(samples.values())
+    if not total:
+        # Telegram rejects empty files
+        try:
+            await application.bot.send_message(chat_id, f"🔥 در {seconds} ثانیه هیچ نمونه‌ای ثبت نشد.")
+        except TelegramError as e:
+            logger.error(f"Error sending profile to {chat_id}: {e}")
+        return
+
+    leaves = Counter()
+    for stack, count in samples.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+
+    caption = f"🔥 پروفایل {seconds} ثانیه - {total} نمونه\n\n"
+    for leaf, count in leaves.most_common(PROFILE_TOP_FUNCTIONS):
+        caption += f"{count * 100 / max(total, 1):.1f}% {leaf}\n"
+    folded = "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+    try:
+        await application.bot.send_document(
+            chat_id,
+            document=folded.encode(),
+            filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded",
+            caption=caption[:1024]
+        )
+    except TelegramError as e:
+        logger.error(f"Error sending profile to {chat_id}: {e}")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Profile the event loop for a few seconds (Super admin only)"""
+    config = get_config(context)
+    user_id = str(update.message.from_user.id)
+
+    if user_id != config.super_admin:
+        return
+
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else 30
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if context.bot_data.get("profiling"):
+        await update.message.reply_text("⏳ یک پروفایل در حال اجراست.")
+        return
+
+    context.bot_data["profiling"] = True
+    start_background_task(
+        context.application, run_profile(context.application, update.effective_chat.id, seconds), name="profile"
+    )
+    await update.message.reply_text(
+        f"🔥 پروفایل‌گیری به مدت {seconds} ثانیه شروع شد. فایل نتیجه ارسال می‌شود.\n"
+        "(قابل مشاهده با speedscope یا flamegraph.pl)"
+    )
+
+def build_application(config: BotConfig, send_request: Optional[TransportRequest] = None,
+                      base_url: str = BOT_API_BASE_URL):
+    """Build the Application for one bot; send_request is an outbound pool to share"""
+    transport = build_transport(send_request)
+    update_processor = BacklogUpdateProcessor(BACKLOG_RATE)
+    app = (
+        ApplicationBuilder()
+        .token(config.token)
+        .base_url(base_url)
+        .request(transport["send"])
+        .get_updates_request(transport["updates"])
+        .concurrent_updates(update_processor)
+        .persistence(SQLitePersistence(data_path(os.path.join(config.name, PERSISTENCE_FILE))))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
+    update_processor.updater = app.updater
+    app.bot_data["config"] = config
+    app.bot_data["transport"] = transport
+
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    
+    # Shared by every handler below and updated in place when the admin file is reloaded
+    role_filters = {role: filters.User(user_id=user_ids) for role, user_ids in role_user_ids(config).items()}
+    app.bot_data["role_filters"] = role_filters
+    admin_filter = role_filters["admins"]
+    secondary_filter = role_filters["secondary"]
 
     app.add_handler(MessageHandler(
-        filters.ALL & ~filters.COMMAND & ~filters.User(user_id=all_admin_ids),
+        filters.ALL & ~filters.COMMAND & ~admin_filter,
         lambda update, context: handle_user_active_conversation(update, context)
     ), group=0)
 
-    secondary_admin_ids = [int(aid) for aid in SECONDARY_ADMINS if aid.isdigit()]
-
     app.add_handler(MessageHandler(
-        filters.User(user_id=secondary_admin_ids) & 
+        secondary_filter & 
         filters.TEXT & 
         filters.Regex(r"^\d+:"),
         handle_admin_direct_reply
     ), group=2)
 
     app.add_handler(MessageHandler(
-        filters.User(user_id=secondary_admin_ids) & 
-        filters.ALL & ~filters.COMMAND,
+        secondary_filter & 
+        filters.ALL & ~filters.COMMAND & ~filters.Regex(r"^\d+:"),
         handle_direct_admin_message
     ), group=3)
 
@@ -1111,7 +4040,9 @@ def main():
             GET_MESSAGE: [MessageHandler(filters.ALL & ~filters.COMMAND, get_message)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="ticket_draft",
+        persistent=True
     )
     
     app.add_handler(CommandHandler("start", start))
@@ -1119,40 +4050,128 @@ def main():
     app.add_handler(CallbackQueryHandler(handle_delegation, pattern="^delegate_"))
     
     app.add_handler(MessageHandler(
-        filters.ALL & ~filters.COMMAND & ~filters.User(user_id=[int(aid) for aid in SECONDARY_ADMINS if aid.isdigit()]),
+        filters.ALL & ~filters.COMMAND & ~secondary_filter,
         lambda update, context: handle_user_active_conversation(update, context)
     ), group=0)
     
     app.add_handler(conv, group=1)
     
     app.add_handler(MessageHandler(
-        filters.User(user_id=[int(aid) for aid in SECONDARY_ADMINS if aid.isdigit()]) & 
+        secondary_filter & 
         filters.TEXT & 
         filters.Regex(r"^\d+:"),
         handle_admin_direct_reply
     ), group=2)
     
     app.add_handler(MessageHandler(
-        filters.User(user_id=[int(aid) for aid in SECONDARY_ADMINS if aid.isdigit()]) & 
-        filters.ALL & ~filters.COMMAND,
+        secondary_filter & 
+        filters.ALL & ~filters.COMMAND & ~filters.Regex(r"^\d+:"),
         handle_direct_admin_message
     ), group=3)
     
     app.add_handler(CommandHandler("endchat", end_chat_command))
+    app.add_handler(CommandHandler("next", next_ticket))
+    app.add_handler(CommandHandler("history", show_history))
     app.add_handler(CommandHandler("fullstatus", full_status))
     app.add_handler(CommandHandler("pending", list_pending_messages))
     app.add_handler(CommandHandler("mytask", list_my_tasks))
     app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("export", export_tickets))
+    app.add_handler(CommandHandler("unmute", unmute_user))
+    app.add_handler(CommandHandler("deadletters", list_dead_letters))
     app.add_handler(CommandHandler("adminstatus", admin_status_command))
     app.add_handler(CommandHandler("broadcast", broadcast_to_admins))
+    app.add_handler(CommandHandler("announce", announce_to_users))
     app.add_handler(CommandHandler("admins", list_all_admins))
     app.add_handler(CommandHandler("mystatus", my_status_command))
+    app.add_handler(CommandHandler("metrics", show_metrics))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("memstats", show_memstats))
+
+    return app
+
+async def run_tenants(configs: List[BotConfig]) -> None:
+    """Host several bots on one event loop with a shared outbound pool and outbox
+
+    Each bot keeps its own long-polling connection, handlers, bot_data (so its
+    own tickets) and DATA_DIR namespace.
+    """
+    send_request = build_send_request()
+    outbox = Outbox()
+    await asyncio.to_thread(outbox.load)
+
+    dashboard = Dashboard(DASHBOARD_HOST, DASHBOARD_PORT) if DASHBOARD_PORT else None
+
+    apps = []
+    for config in configs:
+        app = build_application(config, send_request=send_request)
+        app.bot_data["outbox"] = outbox
+        if dashboard is not None:
+            app.bot_data["dashboard"] = dashboard
+        apps.append(app)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
 
+    workers = [
+        asyncio.create_task(outbox.flush_loop()),
+        asyncio.create_task(transport_autoscale_loop(send_request, outbox)),
+        asyncio.create_task(loop_watchdog()),
+    ]
+    if dashboard is not None:
+        workers.append(asyncio.create_task(dashboard.serve()))
+    try:
+        for app in apps:
+            await app.initialize()
+            await post_init(app)
+        # Delivery starts once every bot is registered; what is left belongs to no bot
+        outbox.bury_orphans()
+        workers.append(asyncio.create_task(outbox.run()))
+        for app in apps:
+            await app.updater.start_polling(drop_pending_updates=False)
+            await app.start()
+            logger.info(f"Bot '{app.bot_data['config'].name}' (@{app.bot.username}) is running")
+        await stop_event.wait()
+    finally:
+        logger.info("Stopping all bots…")
+        for app in apps:
+            if app.updater.running:
+                await app.updater.stop()
+        for app in apps:
+            if app.running:
+                await app.stop()
+                await post_stop(app)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await outbox.flush()
+        for app in apps:
+            await app.shutdown()
+
+def check_settings() -> None:
+    """Reject rate settings that would otherwise divide by zero at the first update"""
+    for name, value in (("FLOOD_RATE", FLOOD_RATE), ("BACKLOG_RATE", BACKLOG_RATE)):
+        if value <= 0:
+            raise ValueError(f"{name} must be greater than 0")
+
+def main():
+    check_settings()
+    configs = load_bot_configs()
+
+    if TENANTS_FILE:
+        print(f"🤖 Hosting {len(configs)} bots…")
+        asyncio.run(run_tenants(configs))
+        return
 
+    app = build_application(configs[0])
     
     logger.info("Bot is starting…")
     print("🤖 Bot is running…")
-    app.run_polling(drop_pending_updates=True)
+    # Updates that arrived while the bot was down are kept and paced by BacklogUpdateProcessor;
+    # SIGTERM/SIGINT stop polling, drain fetched updates and then run post_stop
+    app.run_polling(drop_pending_updates=False)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,231 @@
+"""Soak test: full ticket lifecycles against the local fake Bot API server.
+
+Runs the bot built by main.build_application (the same Application main()
+runs, HTTP pools and outbox included) against fake_bot_api.FakeBotAPI and
+plays every participant itself: each simulated user opens a ticket, a
+primary admin delegates it, the secondary admin answers, the user follows
+up and the admin ends the chat. Every message carries a token, so the
+harness can time its delivery and count messages that never arrive.
+
+Usage: python soak.py [--users N] [--latency S] [--rate-limit P] ...  (see --help)
+"""
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+from collections import Counter, defaultdict
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="soak_"))
+os.environ.setdefault("BACKLOG_RATE", "1000000")
+
+import main
+from fake_bot_api import FakeBotAPI
+
+TOKEN = "424242:soak"
+USER_BASE = 10_000_000
+END_TEXT = "مکالمه شما با تیم پشتیبانی به پایان رسید"
+
+
+class Soak:
+    """Plays users and admins, pushing each next update in reaction to what the bot sends"""
+
+    def __init__(self, api: FakeBotAPI, config: main.BotConfig, think_time: float):
+        self.api = api
+        self.config = config
+        self.think_time = think_time
+        self.message_ids = Counter()
+        self.token_count = 0
+        self.tokens = {}  # token -> {"stage", "user", "expect", "pushed"}
+        self.delivered = Counter()  # token -> deliveries to the expected chat
+        self.latency = defaultdict(list)  # stage -> seconds from push to delivery
+        self.seen_by_primary = set()
+        self.delegated = set()
+        self.assigned = {}  # user_id -> secondary admin answering them
+        self.done = {}  # user_id -> lifecycle finished
+        self.started = {}
+        self.lifecycles = []
+
+    def new_token(self, stage: str, user_id: str, expect) -> str:
+        self.token_count += 1
+        token = f"tok{self.token_count:08d}"
+        self.tokens[token] = {"stage": stage, "user": user_id, "expect": set(expect), "pushed": time.perf_counter()}
+        return token
+
+    def push_message(self, sender: str, text: str) -> None:
+        self.message_ids[sender] += 1
+        message = {
+            "message_id": self.message_ids[sender],
+            "date": int(time.time()),
+            "chat": {"id": int(sender), "type": "private"},
+            "from": {"id": int(sender), "is_bot": False, "first_name": f"u{sender}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.api.push_update(TOKEN, {"message": message})
+
+    def push_callback(self, admin_id: str, message: dict, data: str) -> None:
+        self.api.push_update(TOKEN, {"callback_query": {
+            "id": f"{admin_id}:{message['message_id']}",
+            "from": {"id": int(admin_id), "is_bot": False, "first_name": f"a{admin_id}"},
+            "chat_instance": admin_id,
+            "message": message,
+            "data": data,
+        }})
+
+    def later(self, action, *args) -> None:
+        asyncio.get_running_loop().call_later(self.think_time, action, *args)
+
+    def on_send(self, token: str, method: str, params: dict, message: dict) -> None:
+        chat_id = str(message["chat"]["id"])
+        text = message.get("text") or message.get("caption") or ""
+
+        for word in text.replace("\\", "").split():
+            entry = self.tokens.get(word)
+            if entry is None:
+                continue
+            if entry["stage"] == "question" and chat_id in self.config.primary_admins and word not in self.seen_by_primary:
+                self.seen_by_primary.add(word)
+                self.latency["intake"].append(time.perf_counter() - entry["pushed"])
+            if chat_id not in entry["expect"]:
+                continue
+            self.delivered[word] += 1
+            if self.delivered[word] == 1:
+                self.latency[entry["stage"]].append(time.perf_counter() - entry["pushed"])
+                self.react(entry, chat_id)
+
+        markup = message.get("reply_markup") or {}
+        if method == "sendMessage" and chat_id in self.config.primary_admins and "inline_keyboard" in markup:
+            buttons = [row[0]["callback_data"] for row in markup["inline_keyboard"]]
+            ticket = buttons[0].split("_", 2)[2]
+            if ticket not in self.delegated:
+                # Only the first primary admin to see the ticket delegates it
+                self.delegated.add(ticket)
+                choice = buttons[int(ticket.split("_")[0]) % len(buttons)]
+                self.later(self.push_callback, chat_id, message, choice)
+
+        if END_TEXT in text and chat_id in self.done and not self.done[chat_id].is_set():
+            self.lifecycles.append(time.perf_counter() - self.started[chat_id])
+            self.done[chat_id].set()
+
+    def react(self, entry: dict, chat_id: str) -> None:
+        user_id = entry["user"]
+        if entry["stage"] == "question":
+            self.assigned[user_id] = chat_id
+            answer = self.new_token("answer", user_id, [user_id])
+            self.later(self.push_message, chat_id, f"{user_id}: answer {answer}")
+        elif entry["stage"] == "answer":
+            follow_up = self.new_token("follow_up", user_id, [self.assigned[user_id]])
+            self.later(self.push_message, user_id, f"follow-up {follow_up}")
+        elif entry["stage"] == "follow_up":
+            self.later(self.push_message, chat_id, f"/endchat {user_id}")
+
+    async def user(self, user_id: str) -> None:
+        self.done[user_id] = asyncio.Event()
+        self.started[user_id] = time.perf_counter()
+        question = self.new_token("question", user_id, self.config.secondary_admins)
+        self.push_message(user_id, "📊 فارکس")
+        self.push_message(user_id, f"question {question}")
+        self.push_message(user_id, "📤 ارسال پیام")
+        await self.done[user_id].wait()
+
+
+def percentiles(values) -> str:
+    if len(values) < 2:
+        return " ".join(f"{v * 1000:.0f}ms" for v in values) or "-"
+    q = statistics.quantiles(values, n=100)
+    return f"p50 {q[49] * 1000:.0f}ms  p90 {q[89] * 1000:.0f}ms  p99 {q[98] * 1000:.0f}ms  max {max(values) * 1000:.0f}ms"
+
+
+async def run(args) -> None:
+    api = FakeBotAPI(
+        latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit, retry_after=args.retry_after,
+        failure_rate=args.failure_rate, drop_rate=args.drop_rate, max_rps=args.max_rps, seed=args.seed
+    )
+    await api.start()
+
+    config = main.BotConfig(
+        "soak", TOKEN,
+        [str(9_000_001 + i) for i in range(args.primary)],
+        [str(9_100_001 + i) for i in range(args.secondary)],
+        "9200001", {}
+    )
+    soak = Soak(api, config, args.think_time)
+    api.on_send = soak.on_send
+
+    app = main.build_application(config, base_url=api.base_url)
+    await app.initialize()
+    await main.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def lifecycle(i: int) -> None:
+        async with semaphore:
+            try:
+                await asyncio.wait_for(soak.user(str(USER_BASE + i)), args.timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    started = time.perf_counter()
+    await asyncio.gather(*(lifecycle(i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    outbox = app.bot_data["outbox"]
+    drain_until = time.monotonic() + args.drain
+    while outbox.pending_count("soak") and time.monotonic() < drain_until:
+        await asyncio.sleep(0.1)
+    pending_outbox = outbox.pending_count("soak")
+    dead_letters = len(outbox.dead_letters("soak"))
+
+    await app.updater.stop()
+    await app.stop()
+    await main.post_stop(app)
+    await app.shutdown()
+    await api.stop()
+
+    completed = len(soak.lifecycles)
+    lost = Counter(entry["stage"] for token, entry in soak.tokens.items() if not soak.delivered[token])
+    duplicated = sum(1 for count in soak.delivered.values() if count > 1)
+    print(f"users:                 {args.users} ({completed} lifecycles completed)")
+    print(f"wall time:             {elapsed:.1f}s")
+    print(f"tickets per second:    {completed / elapsed:.1f}")
+    print(f"api calls per second:  {sum(api.calls.values()) / elapsed:.0f}")
+    print(f"injected faults:       {dict(api.faults) or '-'}")
+    print(f"lifecycle latency:     {percentiles(soak.lifecycles)}")
+    for stage in ("intake", "question", "answer", "follow_up"):
+        print(f"{stage + ' latency:':<23}{percentiles(soak.latency[stage])}")
+    print(f"messages sent:         {len(soak.tokens)}")
+    print(f"lost messages:         {sum(lost.values())} {dict(lost) if lost else ''}")
+    print(f"duplicated messages:   {duplicated}")
+    print(f"outbox left / dead:    {pending_outbox} / {dead_letters}")
+    print(f"api calls:             {dict(api.calls.most_common())}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000, help="ticket lifecycles to run")
+    parser.add_argument("--concurrency", type=int, default=200, help="users active at once")
+    parser.add_argument("--primary", type=int, default=2, help="primary admins")
+    parser.add_argument("--secondary", type=int, default=5, help="secondary admins")
+    parser.add_argument("--think-time", type=float, default=0.05, help="seconds before a participant reacts")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="extra random latency in seconds")
+    parser.add_argument("--rate-limit", type=float, default=0.01, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429s")
+    parser.add_argument("--failure-rate", type=float, default=0.005, help="share of calls answered with 500")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of calls whose connection is dropped")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="flood limit in calls per second, 0 for none")
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds a lifecycle may take")
+    parser.add_argument("--drain", type=float, default=30.0, help="seconds to wait for the outbox afterwards")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.ERROR)
+    asyncio.run(run(parse_args()))